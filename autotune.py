@@ -0,0 +1,274 @@
+import json
+import threading
+import time
+
+
+# A limit on how many callers may be inside a block at once, which, unlike a
+# semaphore, can be raised or lowered while callers hold it: lowering it only
+# makes new callers wait until enough of the current ones have left. It also
+# adds up the seconds callers spent waiting, which is how the controller tells
+# that a stage wants more workers than it has.
+class ConcurrencyLimit:
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.wait_seconds = 0.0
+        self._changed = threading.Condition()
+
+    def acquire(self):
+        with self._changed:
+            if self.active >= self.limit:
+                start = time.perf_counter()
+                self.waiting += 1
+                while self.active >= self.limit:
+                    self._changed.wait()
+                self.waiting -= 1
+                self.wait_seconds += time.perf_counter() - start
+            self.active += 1
+
+    def release(self):
+        with self._changed:
+            self.active -= 1
+            self._changed.notify()
+
+    def set_limit(self, limit):
+        with self._changed:
+            self.limit = limit
+            self._changed.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+# Function to read the busy and total CPU time of the whole machine
+def cpu_times():
+    '''
+    From psutil where it is installed (it also works on Windows), else from
+    /proc/stat.
+
+    Returns:
+    tuple: (busy, total) CPU time since boot, in a unit that only matters as
+    a ratio, or None where neither is available.
+    '''
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        times = psutil.cpu_times()._asdict()
+        # Linux counts guest time inside user and nice already
+        times.pop('guest', None)
+        times.pop('guest_nice', None)
+        total = sum(times.values())
+        return total - times['idle'] - times.get('iowait', 0.0), total
+    try:
+        with open('/proc/stat', encoding='ascii') as f:
+            fields = [int(value) for value in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    # user nice system idle iowait irq softirq steal: idle and iowait are not busy
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    total = sum(fields[:8])
+    return total - idle, total
+
+
+# Function to parse "MIN:MAX" for --download-range and --ocr-range
+def parse_range(text):
+    low, _, high = text.partition(':')
+    try:
+        low, high = int(low), int(high or low)
+    except ValueError:
+        raise ValueError(f"expected MIN:MAX, got {text!r}") from None
+    if not 1 <= low <= high:
+        raise ValueError(f"expected 1 <= MIN <= MAX, got {text!r}")
+    return low, high
+
+
+# Adaptive concurrency controller.
+#
+# Every interval seconds it compares the rows/sec of the last interval with
+# the interval before, and looks at each stage's ConcurrencyLimit (how long
+# callers waited for a slot), the stage's mean latency, the fill of the
+# download queue and how busy the CPU was. It then makes at most one change:
+#
+# - a change that did not pay off is undone: a raise has to gain at least
+#   min_gain in rows/sec, a cut may lose at most min_gain. That direction of
+#   that stage is then left alone for hold intervals;
+# - OCR gets one more worker while OCR calls are waiting for a slot and the
+#   CPU has room, and one fewer when the CPU is saturated and OCR latency
+#   has grown well past the best seen (workers only take turns on the cores);
+# - downloads get half as many again while they are waiting for a slot and
+#   the downloaded images are not piling up in front of OCR, and a quarter
+#   fewer when download latency has doubled from the best seen (the hosts or
+#   the network are saturated) while more downloads would not help: there is
+#   no download queue or it is nearly full, i.e. OCR is the bottleneck.
+#
+# Each stage stays within its (minimum, maximum). Every decision is printed
+# and appended as a JSON line to log_path, so the limits a run settles on
+# can be pinned for the next one.
+class ConcurrencyController:
+    def __init__(self, metrics, stages, interval=15.0, queue_fill=None, log_path=None,
+                 min_gain=0.05, hold=3, busy_cpu=0.9):
+        '''
+        stages maps a stage name ('download', 'ocr') to (ConcurrencyLimit,
+        minimum, maximum); the stage's latency is read from the histogram of
+        the same name in metrics. queue_fill returns how full the queue
+        between downloads and OCR is, from 0 to 1, if there is one.
+        '''
+        self.metrics = metrics
+        self.stages = stages
+        self.interval = interval
+        self.queue_fill = queue_fill
+        self.log_path = log_path
+        self.min_gain = min_gain
+        self.hold = hold
+        self.busy_cpu = busy_cpu
+        self.decisions = 0
+        self._held = {}
+        self._best_latency = {}
+        self._last_change = None
+        self._previous = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def limits(self):
+        return {name: limit.limit for name, (limit, _, _) in self.stages.items()}
+
+    def _sample(self):
+        rows_done, totals = self.metrics.stage_totals()
+        return {
+            'time': time.monotonic(),
+            'rows_done': rows_done,
+            'totals': totals,
+            'waits': {name: limit.wait_seconds for name, (limit, _, _) in self.stages.items()},
+            'waiting': {name: limit.waiting for name, (limit, _, _) in self.stages.items()},
+            'cpu': cpu_times(),
+        }
+
+    def _measure(self, previous, current):
+        seconds = current['time'] - previous['time']
+        measured = {
+            'rows_per_sec': (current['rows_done'] - previous['rows_done']) / seconds,
+            'latency': {},
+            # Callers waiting for a slot: on average over the interval, or right now if
+            # they are still stuck (their wait is only added up once it ends)
+            'waiting': {name: max((current['waits'][name] - previous['waits'][name]) / seconds,
+                                  current['waiting'][name]) for name in self.stages},
+            'cpu': None,
+            'queue_fill': None,
+        }
+        for name in self.stages:
+            count, total = current['totals'].get(name, (0, 0.0))
+            previous_count, previous_total = previous['totals'].get(name, (0, 0.0))
+            if count > previous_count:
+                measured['latency'][name] = (total - previous_total) / (count - previous_count)
+        if previous['cpu'] is not None and current['cpu'] is not None and current['cpu'][1] > previous['cpu'][1]:
+            measured['cpu'] = (current['cpu'][0] - previous['cpu'][0]) / (current['cpu'][1] - previous['cpu'][1])
+        if self.queue_fill is not None:
+            try:
+                measured['queue_fill'] = self.queue_fill()
+            except Exception:
+                pass
+        return measured
+
+    def _set(self, name, new_limit, reason, measured):
+        limit, _, _ = self.stages[name]
+        old_limit = limit.limit
+        limit.set_limit(new_limit)
+        self.decisions += 1
+        cpu = f", CPU {100 * measured['cpu']:.0f}%" if measured['cpu'] is not None else ""
+        print(f"Autotune: {name} {old_limit} -> {new_limit} ({reason}{cpu}, {measured['rows_per_sec']:.1f} rows/s)")
+        if self.log_path:
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'time': time.time(), 'stage': name, 'from': old_limit, 'to': new_limit,
+                                    'reason': reason, 'limits': self.limits(), **measured}) + '\n')
+        return old_limit
+
+    def step(self, measured):
+        '''
+        Make at most one change based on one interval's measurements.
+        '''
+        for key in list(self._held):
+            self._held[key] -= 1
+            if self._held[key] <= 0:
+                del self._held[key]
+        for name, latency in measured['latency'].items():
+            self._best_latency[name] = min(latency, self._best_latency.get(name, latency))
+
+        rate = measured['rows_per_sec']
+        if self._last_change is not None:
+            name, old_limit, direction, rate_before = self._last_change
+            self._last_change = None
+            if direction > 0:
+                paid_off = rate >= rate_before * (1 + self.min_gain)
+            else:
+                paid_off = rate >= rate_before * (1 - self.min_gain)
+            if not paid_off:
+                self._held[(name, direction)] = self.hold
+                self._set(name, old_limit, f"undone, {rate_before:.1f} rows/s before it", measured)
+                return
+
+        for name, new_limit, reason in self._proposals(measured):
+            limit, minimum, maximum = self.stages[name]
+            new_limit = max(minimum, min(maximum, new_limit))
+            direction = 1 if new_limit > limit.limit else -1
+            if new_limit == limit.limit or (name, direction) in self._held:
+                continue
+            old_limit = self._set(name, new_limit, reason, measured)
+            self._last_change = (name, old_limit, direction, rate)
+            return
+
+    def _proposals(self, measured):
+        # Candidate changes, the most pressing first
+        cpu = measured['cpu']
+        queue_fill = measured['queue_fill']
+        proposals = []
+        if 'ocr' in self.stages:
+            limit = self.stages['ocr'][0].limit
+            latency = measured['latency'].get('ocr')
+            best = self._best_latency.get('ocr')
+            if cpu is not None and cpu >= self.busy_cpu and latency is not None and latency > 1.5 * best:
+                proposals.append(('ocr', limit - 1, f"CPU saturated, OCR {1000 * latency:.0f}ms vs best "
+                                                    f"{1000 * best:.0f}ms"))
+            elif measured['waiting']['ocr'] >= 0.5 and (cpu is None or cpu < self.busy_cpu):
+                proposals.append(('ocr', limit + 1, f"{measured['waiting']['ocr']:.1f} OCR calls waiting"))
+        if 'download' in self.stages:
+            limit = self.stages['download'][0].limit
+            latency = measured['latency'].get('download')
+            best = self._best_latency.get('download')
+            if latency is not None and latency > 2 * best and (queue_fill is None or queue_fill >= 0.9):
+                proposals.append(('download', limit - max(1, limit // 4),
+                                  f"downloads {1000 * latency:.0f}ms vs best {1000 * best:.0f}ms"))
+            elif measured['waiting']['download'] >= 0.5 and (queue_fill is None or queue_fill < 0.5):
+                proposals.append(('download', limit + max(1, limit // 2),
+                                  f"{measured['waiting']['download']:.1f} downloads waiting"))
+        return proposals
+
+    def start(self):
+        if cpu_times() is None:
+            print("Autotune: no CPU readings on this machine (install psutil), so OCR is never cut back "
+                  "for a saturated CPU")
+
+        def run():
+            self._previous = self._sample()
+            while not self._stop.wait(self.interval):
+                current = self._sample()
+                measured = self._measure(self._previous, current)
+                self._previous = current
+                # Nothing finished: the run is starting up or ending, neither says anything about the limits
+                if current['rows_done'] == 0 or measured['rows_per_sec'] == 0:
+                    continue
+                self.step(measured)
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,706 @@
+import argparse
+import csv
+import functools
+import http.server
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from image_cache import ImageCache
+
+
+# Local stand-in for the image host: serves a directory over keep-alive HTTP
+# and sleeps `latency` seconds per request to imitate network round trips.
+class SlowImageHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_directory(directory, latency=0.0):
+    handler = type("Handler", (SlowImageHandler,), {"latency": latency})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(handler, directory=directory))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def image_names(directory):
+    return sorted(name for name in os.listdir(directory) if not name.startswith("."))
+
+
+def make_image_urls(base_url, directory, count):
+    # A distinct query string per row, so every row is a cache miss on a cold cache
+    names = image_names(directory)
+    return [f"{base_url}/{names[i % len(names)]}?row={i}" for i in range(count)]
+
+
+def make_ocr(fake_ocr_ms):
+    if fake_ocr_ms is not None:
+        def ocr(image_save_path):
+            time.sleep(fake_ocr_ms / 1000)
+            return ""
+        return ocr
+
+    import main
+    main.init_ocr_worker()
+    return main.ocr_image
+
+
+def bench_fused(urls, ocr, workers):
+    # Today's path: every worker downloads, then OCRs, one row at a time
+    cache = ImageCache(tempfile.mkdtemp(prefix="bench-cache-"))
+
+    def process(url):
+        ocr(cache.fetch(url))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(process, urls))
+    return time.perf_counter() - start
+
+
+def bench_async(urls, ocr, ocr_workers, concurrency, per_host, queue_size):
+    from fetcher import AsyncImageFetcher, run_pipelined
+
+    cache = ImageCache(tempfile.mkdtemp(prefix="bench-cache-"))
+    fetcher = AsyncImageFetcher(cache, concurrency=concurrency, per_host=per_host, queue_size=queue_size)
+
+    def process_image(url, image_save_path, error):
+        if error is not None:
+            raise error
+        return ocr(image_save_path)
+
+    start = time.perf_counter()
+    run_pipelined(((url, url) for url in urls), process_image, lambda url, result: None, fetcher,
+                  ocr_workers=ocr_workers)
+    return time.perf_counter() - start
+
+
+def run_fetch_benchmark(args):
+    directory = args.images
+    if directory is None:
+        if args.fake_ocr_ms is None:
+            raise SystemExit("--fake-ocr-ms is required when no --images directory is given")
+        directory = tempfile.mkdtemp(prefix="bench-images-")
+        for i in range(16):
+            with open(os.path.join(directory, f"{i}.jpg"), "wb") as f:
+                f.write(os.urandom(args.image_bytes))
+
+    server, base_url = serve_directory(directory, latency=args.latency_ms / 1000)
+    try:
+        urls = make_image_urls(base_url, directory, args.rows)
+        ocr = make_ocr(args.fake_ocr_ms)
+
+        fused = bench_fused(urls, ocr, args.workers)
+        pipelined = bench_async(urls, ocr, args.ocr_workers, args.download_concurrency, args.per_host, args.queue_size)
+    finally:
+        server.shutdown()
+
+    print(f"fused  ({args.workers} threads): {len(urls) / fused:8.1f} images/sec")
+    print(f"async  ({args.ocr_workers} OCR threads, {args.download_concurrency} downloads): "
+          f"{len(urls) / pipelined:8.1f} images/sec")
+
+
+def list_images(directory, count):
+    names = image_names(directory)
+    return [os.path.join(directory, names[i % len(names)]) for i in range(count)]
+
+
+def run_ocr_benchmark(args):
+    # Same images, same OCR function, threads vs a process pool
+    import main
+
+    paths = list_images(args.images, args.rows)
+    thread_workers = args.threads
+    process_workers = args.processes or os.cpu_count()
+
+    main.init_ocr_worker(settings={"ocr_backend": args.backend})
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=thread_workers) as executor:
+        list(executor.map(main.ocr_image, paths))
+    threaded = time.perf_counter() - start
+
+    executor = main.make_ocr_executor(process_workers, {"ocr_backend": args.backend})
+    # Start the workers before timing so their one-off initialization is not counted
+    list(executor.map(abs, range(process_workers)))
+    start = time.perf_counter()
+    with executor:
+        list(executor.map(main.ocr_image, paths, chunksize=4))
+    pooled = time.perf_counter() - start
+
+    print(f"thread  ({thread_workers} threads):   {len(paths) / threaded:8.1f} images/sec")
+    print(f"process ({process_workers} processes): {len(paths) / pooled:8.1f} images/sec")
+
+
+# OCR-like lines for the parse benchmark when no --corpus is given
+SAMPLE_OCR_LINES = [
+    "awd test\n1238madw\n823W\n100.23 m\n\nPower adapter\n\n@AC cable",
+    "Dimensions: {n} x {n} x {n} cm\nMade in China",
+    "NET WT {n}g ({n} oz)",
+    "Input: 100-240V ~ 50/60Hz\nOutput: {n}V {n}A\nPower {n}W",
+    "Capacity {n} fl oz / {n} ml",
+    "{n} cu ft storage",
+    "Max load {n} lbs\n{n} kg",
+    "Vitamin D {n}μg\nCalcium {n} mg",
+    "Height: {n}\"  Width: {n}'",
+    "SALE!!! Buy now\nfree shipping\nwww.example.com",
+]
+
+
+def make_parse_corpus(rows, seed=0):
+    import main
+
+    rng = random.Random(seed)
+    entity_names = sorted(main.entity_unit_map)
+    corpus = []
+    for _ in range(rows):
+        template = rng.choice(SAMPLE_OCR_LINES)
+        text = template.replace("{n}", "{}").format(*(
+            f"{rng.uniform(0.5, 500):.{rng.choice([0, 1, 2])}f}" for _ in range(template.count("{n}"))))
+        corpus.append((text, rng.choice(entity_names)))
+    return corpus
+
+
+def load_parse_corpus(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return [(record["text"], record["entity_name"]) for record in csv.DictReader(f)]
+
+
+def run_parse_benchmark(args):
+    import main
+
+    corpus = load_parse_corpus(args.corpus) if args.corpus else make_parse_corpus(args.rows)
+
+    def legacy(text, entity_name):
+        # What predictor() did per row before the matchers were precompiled
+        valid_units = main.entity_unit_map[entity_name]
+        unit_mapping = main.generate_abbreviation_map(entity_name, main.entity_unit_map, main.abbreviation_map)
+        return main.extract_number_and_unit(text, valid_units, unit_mapping)
+
+    # The compiled matcher's spellings as one plain regex alternation, longest first
+    plain_matchers = {}
+    for entity_name in main.entity_unit_map:
+        lookup = main.get_unit_matcher(entity_name)[1]
+        alternation = "|".join(re.escape(spelling) for spelling in sorted(lookup, key=len, reverse=True))
+        plain_matchers[entity_name] = (re.compile(r"(\d+(?:\.\d+)?)\s*(" + alternation + r")(?![^\W\d_])",
+                                                  re.IGNORECASE), lookup)
+
+    def alternation(text, entity_name):
+        return main.match_entity_value(text, *plain_matchers[entity_name])
+
+    results = {}
+    for name, extract in (("legacy", legacy), ("alternation", alternation), ("compiled", main.extract_entity_value)):
+        extract(*corpus[0])
+        start = time.perf_counter()
+        results[name] = [extract(text, entity_name) for text, entity_name in corpus]
+        elapsed = time.perf_counter() - start
+        found = sum(1 for answer in results[name] if answer)
+        print(f"{name:11s} {len(corpus) / elapsed:10.0f} rows/sec, {found} rows with a value")
+
+    changed = sum(1 for old, new in zip(results["legacy"], results["compiled"]) if old != new)
+    print(f"{changed} of {len(corpus)} answers differ between legacy and compiled")
+    if results["alternation"] != results["compiled"]:
+        print("WARNING: alternation and compiled answers differ")
+
+    # One image asked about several entities: a regex pass per entity vs one tokenizing
+    # pass, which predict_all_from_text switches to at SINGLE_PASS_MIN_ENTITIES
+    entity_names = sorted(main.entity_unit_map)
+    texts = [text for text, _ in corpus]
+
+    def tokenized(text, asked):
+        candidates = main.extract_unit_candidates(text)
+        return [main.select_entity_value(candidates, entity_name) for entity_name in asked]
+
+    for count in range(2, len(entity_names) + 1):
+        asked = entity_names[:count]
+        start = time.perf_counter()
+        per_entity = [[main.extract_entity_value(text, entity_name) for entity_name in asked] for text in texts]
+        per_entity_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        single_pass = [tokenized(text, asked) for text in texts]
+        single_pass_elapsed = time.perf_counter() - start
+        used = "single pass" if count >= main.SINGLE_PASS_MIN_ENTITIES else "per entity"
+        print(f"{count} entities per text: per entity {len(texts) / per_entity_elapsed:8.0f} texts/sec, "
+              f"single pass {len(texts) / single_pass_elapsed:8.0f} texts/sec (predict_all_from_text: {used})")
+        if single_pass != per_entity:
+            print("WARNING: single pass and per entity answers differ")
+
+
+def run_decode_benchmark(args):
+    # imread in colour + cvtColor (the old path) vs imdecode straight to grayscale
+    import cv2
+    import main
+
+    paths = list_images(args.images, args.rows)
+    blobs = []
+    for path in paths:
+        with open(path, "rb") as f:
+            blobs.append(f.read())
+
+    def imread_gray(path, data):
+        return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2GRAY)
+
+    variants = [("imread+cvtColor", imread_gray)]
+    for scale in (1, 2, 4):
+        variants.append((f"imdecode 1/{scale}", lambda path, data, scale=scale: main.decode_grayscale(data, scale)))
+    if args.target_text_height:
+        variants.append((f"imdecode text<={args.target_text_height}px", lambda path, data: main.decode_grayscale(
+            data, 1, args.target_text_height)))
+
+    for name, decode in variants:
+        start = time.perf_counter()
+        for path, data in zip(paths, blobs):
+            decode(path, data)
+        elapsed = time.perf_counter() - start
+
+        # Peak memory of decoding one image (numpy arrays, including OpenCV outputs, show up in tracemalloc)
+        tracemalloc.start()
+        decode(paths[0], blobs[0])
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:24s} {1000 * elapsed / len(paths):7.2f} ms/image, {peak / 1024:9.1f} KiB peak per image")
+
+
+# What the OCR worker does first with an image, without tesseract, so only the handoff differs
+def threshold_image(gray):
+    import cv2
+    return int(cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)[0, 0])
+
+
+def threshold_shared_image(ref):
+    import main
+    with main.image_ring.read(ref) as gray:
+        return threshold_image(gray)
+
+
+def run_handoff_benchmark(args):
+    # Decoded images sent to OCR processes pickled vs through the shared-memory ring
+    import main
+    from shm_ring import SharedImageRing
+
+    paths = list_images(args.images, args.rows)
+    blobs = []
+    for path in paths:
+        with open(path, "rb") as f:
+            blobs.append(f.read())
+    processes = args.processes or os.cpu_count()
+    ring = SharedImageRing(args.slots or processes * 2, args.slot_mb * 1024 ** 2)
+
+    def pickled(executor, data):
+        return executor.submit(threshold_image, main.decode_grayscale(data)).result()
+
+    def shared(executor, data):
+        ref = ring.put(main.decode_grayscale(data))
+        try:
+            return executor.submit(threshold_shared_image, ref).result()
+        finally:
+            ring.release(ref)
+
+    try:
+        for name, handoff in (("pickled", pickled), ("shared memory", shared)):
+            executor = main.make_ocr_executor(processes, ring=ring)
+            list(executor.map(abs, range(processes)))
+            start = time.perf_counter()
+            with executor, ThreadPoolExecutor(max_workers=args.threads) as threads:
+                list(threads.map(functools.partial(handoff, executor), blobs))
+            elapsed = time.perf_counter() - start
+            print(f"{name:14s} {len(blobs) / elapsed:8.1f} images/sec")
+        megapixels = sum(main.decode_grayscale(data).size for data in blobs) / len(blobs) / 1e6
+        print(f"{megapixels:.2f} megapixels per image on average, {ring.waits} waits for a free slot")
+    finally:
+        ring.close()
+
+
+def run_regions_benchmark(args):
+    # Whole-image OCR vs OCR of detected text lines only: time, area sent to OCR, and
+    # how many of the whole-image answers the region path still finds
+    import cv2
+    import main
+    from text_regions import detect_text_regions, region_area_fraction
+
+    paths = list_images(args.images, args.rows)
+    grays = [cv2.imread(path, cv2.IMREAD_GRAYSCALE) for path in paths]
+
+    start = time.perf_counter()
+    region_lines = [detect_text_regions(gray) for gray in grays]
+    detect_time = time.perf_counter() - start
+    coverage = sum(region_area_fraction(lines, gray) for lines, gray in zip(region_lines, grays)) / len(grays)
+    print(f"detection: {1000 * detect_time / len(grays):.2f} ms/image, "
+          f"{100 * coverage:.1f}% of pixels sent to OCR on average")
+
+    whole = time_read_image_text(grays, {"ocr_backend": args.backend}, "whole image")
+    regions = time_read_image_text(grays, {"ocr_backend": args.backend, "text_regions": True,
+                                           "region_workers": args.region_workers}, "regions")
+    print_recall(whole, regions, "whole image")
+
+
+def run_tiles_benchmark(args):
+    # Whole-image OCR vs overlapping tiles OCRed in parallel, on the images above the tile size
+    import cv2
+
+    paths = list_images(args.images, args.rows)
+    grays = [gray for gray in (cv2.imread(path, cv2.IMREAD_GRAYSCALE) for path in paths)
+             if max(gray.shape) > args.tile_size]
+    if not grays:
+        raise SystemExit(f"No image in {args.images} has a side longer than {args.tile_size} pixels")
+
+    whole = time_read_image_text(grays, {"ocr_backend": args.backend}, "whole image")
+    tiles = time_read_image_text(grays, {"ocr_backend": args.backend, "tile_size": args.tile_size,
+                                         "tile_overlap": args.tile_overlap, "region_workers": args.tile_workers},
+                                 "tiles")
+    print_recall(whole, tiles, "whole image")
+
+
+def time_read_image_text(grays, settings, name):
+    import main
+
+    main.init_ocr_worker(settings=dict(main.ocr_settings, **settings))
+    start = time.perf_counter()
+    texts = [main.read_image_text(gray) for gray in grays]
+    elapsed = time.perf_counter() - start
+    print(f"{name:12s} {len(grays) / elapsed:8.2f} images/sec")
+    return texts
+
+
+def print_recall(reference_texts, texts, reference_name):
+    # Share of the reference path's answers (over every entity) that the other path also gives
+    import main
+
+    found, kept = 0, 0
+    for reference_text, text in zip(reference_texts, texts):
+        for entity_name in main.entity_unit_map:
+            answer = main.extract_entity_value(reference_text, entity_name)
+            if answer:
+                found += 1
+                kept += answer == main.extract_entity_value(text, entity_name)
+    if found:
+        print(f"recall vs {reference_name}: {kept}/{found} ({100 * kept / found:.1f}%)")
+
+
+def run_cascade_benchmark(args):
+    # The full pass on every image vs the cascade, for one entity per image
+    from collections import Counter
+
+    import cv2
+    import main
+
+    paths = list_images(args.images, args.rows)
+    grays = [cv2.imread(path, cv2.IMREAD_GRAYSCALE) for path in paths]
+    full = time_read_image_text(grays, {"ocr_backend": args.backend}, "full pass")
+
+    main.init_ocr_worker(settings=dict(main.ocr_settings, ocr_backend=args.backend, cascade=True))
+    tiers = Counter()
+    cascade = []
+    start = time.perf_counter()
+    for gray in grays:
+        text, tier, _ = main.read_image_text_cascade(gray, [args.entity])
+        tiers[tier] += 1
+        cascade.append(text)
+    elapsed = time.perf_counter() - start
+    print(f"{'cascade':12s} {len(grays) / elapsed:8.2f} images/sec  "
+          + ", ".join(f"{tier} {count}" for tier, count in tiers.most_common()))
+
+    full_found = [bool(main.extract_entity_value(text, args.entity)) for text in full]
+    cascade_found = [bool(main.extract_entity_value(text, args.entity)) for text in cascade]
+    both = sum(1 for a, b in zip(full_found, cascade_found) if a and b)
+    print(f"{args.entity} found: full pass {sum(full_found)}, cascade {sum(cascade_found)}, both {both}")
+
+
+# Labelled values drawn on the synthetic images: entity, text on the image, expected prediction
+SYNTHETIC_LABELS = [
+    ("width", "{v} inch", "{v} inch"),
+    ("height", "{v} cm", "{v} centimetre"),
+    ("depth", "{v} mm", "{v} millimetre"),
+    ("item_weight", "Net Wt {v} g", "{v} gram"),
+    ("maximum_weight_recommendation", "Max load {v} kg", "{v} kilogram"),
+    ("voltage", "500 mAh {v} V", "{v} volt"),
+    ("wattage", "Power {v}W", "{v} watt"),
+    ("item_volume", "{v} fl oz", "{v} fluid ounce"),
+]
+SYNTHETIC_DISTRACTORS = ["NEW", "Premium Quality", "Made in China", "BEST SELLER", "Easy to use", "Model X-200"]
+
+
+def load_font(size):
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype("DejaVuSans.ttf", size)
+    except OSError:
+        return ImageFont.load_default(size=size)
+
+
+def make_synthetic_dataset(directory, count, seed=0, noise=8.0, max_rotation=4.0):
+    '''
+    Render product-like JPEGs with PIL: a tinted background, a few blocks
+    standing in for the product photo, distractor text and one labelled
+    value, then a small rotation and gaussian noise.
+
+    Returns:
+    list: dicts with path, entity_name and the expected prediction.
+    '''
+    import numpy as np
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    noise_rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    samples = []
+    for i in range(count):
+        entity_name, template, expected = rng.choice(SYNTHETIC_LABELS)
+        value = f"{rng.uniform(1, 999):.{rng.choice([0, 1, 2])}f}"
+        width, height = rng.choice([(600, 600), (1000, 1000), (1500, 1200), (2000, 2000)])
+
+        background = tuple(rng.randint(200, 255) for _ in range(3))
+        image = Image.new("RGB", (width, height), background)
+        draw = ImageDraw.Draw(image)
+        for _ in range(rng.randint(1, 4)):
+            x0, y0 = rng.randint(0, width - 50), rng.randint(0, height - 50)
+            x1, y1 = x0 + rng.randint(40, width // 2), y0 + rng.randint(40, height // 2)
+            draw.rectangle((x0, y0, x1, y1), fill=tuple(rng.randint(60, 200) for _ in range(3)))
+
+        lines = rng.sample(SYNTHETIC_DISTRACTORS, 2)
+        lines.insert(rng.randint(0, 2), template.format(v=value))
+        font = load_font(max(18, height // rng.randint(18, 30)))
+        y = rng.randint(10, height // 4)
+        for line in lines:
+            draw.text((rng.randint(width // 20, width // 6), y), line, fill=(0, 0, 0), font=font)
+            y += int(font.size * 1.8)
+
+        image = image.rotate(rng.uniform(-max_rotation, max_rotation), expand=False, fillcolor=background)
+        pixels = np.asarray(image).astype(np.float32)
+        pixels += noise_rng.normal(0, noise, pixels.shape)
+        image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+        path = os.path.join(directory, f"{i:05d}.jpg")
+        image.save(path, quality=90)
+        samples.append({"path": path, "entity_name": entity_name, "expected": expected.format(v=value)})
+    return samples
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def peak_rss_mib():
+    # Peak resident set size of this process. Not of its children: a forked child's
+    # ru_maxrss starts from the parent's size at fork and survives exec, so
+    # RUSAGE_CHILDREN says more about this process than about tesseract
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+# What each kind of process imports and sets up before its first piece of work
+STARTUP_ROLES = [
+    ("driver", "import main, fetcher, result_sink, scheduler"),
+    ("OCR worker", "import main; main.init_ocr_worker()"),
+    ("parse worker", "import evaluate; evaluate.parse_batch([('Width 16.54 cm', ['width'])])"),
+]
+
+
+def run_startup_benchmark(args):
+    # Each role in a fresh interpreter, the way a spawned worker process starts
+    import subprocess
+
+    probe = ("import sys, time; start = time.perf_counter(); {setup}; ready = time.perf_counter() - start; "
+             "sys.path.insert(0, {here!r}); from benchmark import peak_rss_mib; "
+             "print(ready, peak_rss_mib(), ' '.join(sorted(name for name in ('pandas', 'cv2', 'numpy', 'aiohttp', "
+             "'pytesseract', 'PIL') if name in sys.modules)))")
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name, setup in STARTUP_ROLES:
+        walls, readies, rss = [], [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, "-c", probe.format(setup=setup, here=here)], cwd=here,
+                                    capture_output=True, text=True, check=True).stdout.split(maxsplit=2)
+            walls.append(time.perf_counter() - start)
+            readies.append(float(output[0]))
+            rss.append(float(output[1]))
+        loaded = output[2].strip() if len(output) > 2 else "-"
+        print(f"{name:13s} {1000 * percentile(walls, 0.5):6.0f} ms to ready ({1000 * percentile(readies, 0.5):4.0f} ms "
+              f"importing), {percentile(rss, 0.5):6.1f} MiB peak RSS, loads: {loaded}")
+
+
+def print_latencies(name, latencies):
+    print(f"{name:10s} p50 {1000 * percentile(latencies, 0.5):8.2f} ms   p95 {1000 * percentile(latencies, 0.95):8.2f} ms   "
+          f"{len(latencies) / sum(latencies):8.1f} images/sec (serial)")
+
+
+def run_pipeline_benchmark(args):
+    # Every stage on its own, then predictor() end to end, on labelled synthetic images.
+    # The images (unless --images is given), image cache and OCR store are removed afterwards
+    with tempfile.TemporaryDirectory(prefix="bench-pipeline-") as scratch:
+        bench_pipeline(args, scratch)
+
+
+def bench_pipeline(args, scratch):
+    import cv2
+    import main
+
+    directory = args.images or os.path.join(scratch, "images")
+    samples = make_synthetic_dataset(directory, args.rows, seed=args.seed)
+    main.init_ocr_worker(settings=dict(main.ocr_settings, ocr_backend=args.backend))
+    engine = main.get_engine(args.backend)
+
+    stages = {"decode": [], "preprocess": [], "ocr": [], "parse": []}
+    correct = 0
+    for sample in samples:
+        with open(sample["path"], "rb") as f:
+            data = f.read()
+        start = time.perf_counter()
+        gray = main.decode_grayscale(data, main.ocr_settings["decode_scale"], main.ocr_settings["target_text_height"])
+        decoded = time.perf_counter()
+        thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+        preprocessed = time.perf_counter()
+        text = engine.image_to_string(thresh, config=main.OCR_CONFIG)
+        recognised = time.perf_counter()
+        answer = main.extract_entity_value(text, sample["entity_name"])
+        parsed = time.perf_counter()
+
+        stages["decode"].append(decoded - start)
+        stages["preprocess"].append(preprocessed - decoded)
+        stages["ocr"].append(recognised - preprocessed)
+        stages["parse"].append(parsed - recognised)
+        correct += answer == sample["expected"]
+
+    print(f"stages over {len(samples)} synthetic images ({args.backend}):")
+    for name, latencies in stages.items():
+        print_latencies(name, latencies)
+    print(f"stage accuracy: {correct}/{len(samples)} exact matches ({100 * correct / len(samples):.1f}%)")
+
+    # predictor() end to end through the local HTTP stand-in, with a cold image cache and OCR store
+    main.IMAGE_CACHE_DIR = os.path.join(scratch, "image_cache")
+    main.OCR_STORE_PATH = os.path.join(scratch, "ocr_store.sqlite")
+    server, base_url = serve_directory(directory, latency=args.latency_ms / 1000)
+
+    def timed_predictor(sample):
+        url = f"{base_url}/{os.path.basename(sample['path'])}"
+        start = time.perf_counter()
+        answer = main.predictor(url, None, sample["entity_name"])
+        return time.perf_counter() - start, answer == sample["expected"]
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            results = list(executor.map(timed_predictor, samples))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        main.get_ocr_store().close()
+
+    latencies = [latency for latency, _ in results]
+    correct = sum(1 for _, ok in results if ok)
+    print(f"predictor() end to end, {args.workers} threads: {len(samples) / elapsed:.2f} images/sec, "
+          f"p50 {1000 * percentile(latencies, 0.5):.1f} ms, p95 {1000 * percentile(latencies, 0.95):.1f} ms, "
+          f"accuracy {correct}/{len(samples)} ({100 * correct / len(samples):.1f}%)")
+
+    own = peak_rss_mib()
+    if own is not None:
+        # Everything above ran in this process, except the tesseract binary pytesseract starts per image
+        scope = "driver process"
+        if args.backend == "pytesseract":
+            scope += " only, not the tesseract processes"
+        print(f"peak RSS: {own:.1f} MiB ({scope})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the OCR pipeline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    fetch = subparsers.add_parser("fetch", help="fused download+OCR threads vs the async download stage")
+    fetch.add_argument("--images", help="directory of images to serve (default: random bytes, needs --fake-ocr-ms)")
+    fetch.add_argument("--rows", type=int, default=500)
+    fetch.add_argument("--latency-ms", type=float, default=80)
+    fetch.add_argument("--image-bytes", type=int, default=60_000)
+    fetch.add_argument("--fake-ocr-ms", type=float, help="sleep instead of running tesseract")
+    fetch.add_argument("--workers", type=int, default=8)
+    fetch.add_argument("--ocr-workers", type=int, default=8)
+    fetch.add_argument("--download-concurrency", type=int, default=64)
+    fetch.add_argument("--per-host", type=int, default=16)
+    fetch.add_argument("--queue-size", type=int, default=256)
+    fetch.set_defaults(func=run_fetch_benchmark)
+
+    ocr = subparsers.add_parser("ocr", help="OCR stage in threads vs in a process pool")
+    ocr.add_argument("--images", required=True, help="directory of images to OCR")
+    ocr.add_argument("--rows", type=int, default=200)
+    ocr.add_argument("--threads", type=int, default=8)
+    ocr.add_argument("--processes", type=int, help="default: one per core")
+    ocr.add_argument("--backend", choices=["pytesseract", "tesserocr"], default="pytesseract")
+    ocr.set_defaults(func=run_ocr_benchmark)
+
+    parse = subparsers.add_parser("parse", help="per-row extract_number_and_unit vs the precompiled matchers and the single-pass extractor")
+    parse.add_argument("--corpus", help="CSV with text and entity_name columns (default: synthetic OCR strings)")
+    parse.add_argument("--rows", type=int, default=50_000)
+    parse.set_defaults(func=run_parse_benchmark)
+
+    decode = subparsers.add_parser("decode", help="decode time and memory per image for each decode path")
+    decode.add_argument("--images", required=True, help="directory of images")
+    decode.add_argument("--rows", type=int, default=200)
+    decode.add_argument("--target-text-height", type=int, help="also time text-height based downscaling")
+    decode.set_defaults(func=run_decode_benchmark)
+
+    handoff = subparsers.add_parser("handoff", help="decoded images to OCR processes pickled vs through shared memory")
+    handoff.add_argument("--images", required=True, help="directory of images")
+    handoff.add_argument("--rows", type=int, default=200)
+    handoff.add_argument("--threads", type=int, default=4, help="threads decoding and handing images over")
+    handoff.add_argument("--processes", type=int, help="default: one per core")
+    handoff.add_argument("--slots", type=int, help="default: two per process")
+    handoff.add_argument("--slot-mb", type=int, default=16)
+    handoff.set_defaults(func=run_handoff_benchmark)
+
+    regions = subparsers.add_parser("regions", help="whole-image OCR vs OCR of detected text lines")
+    regions.add_argument("--images", required=True, help="directory of images")
+    regions.add_argument("--rows", type=int, default=100)
+    regions.add_argument("--backend", choices=["pytesseract", "tesserocr"], default="pytesseract")
+    regions.add_argument("--region-workers", type=int, default=4)
+    regions.set_defaults(func=run_regions_benchmark)
+
+    tiles = subparsers.add_parser("tiles", help="whole-image OCR vs overlapping tiles OCRed in parallel")
+    tiles.add_argument("--images", required=True, help="directory of images")
+    tiles.add_argument("--rows", type=int, default=20)
+    tiles.add_argument("--backend", choices=["pytesseract", "tesserocr"], default="pytesseract")
+    tiles.add_argument("--tile-size", type=int, default=1600)
+    tiles.add_argument("--tile-overlap", type=int, default=200)
+    tiles.add_argument("--tile-workers", type=int, default=os.cpu_count())
+    tiles.set_defaults(func=run_tiles_benchmark)
+
+    cascade = subparsers.add_parser("cascade", help="full OCR pass on every image vs the OCR cascade")
+    cascade.add_argument("--images", required=True, help="directory of images")
+    cascade.add_argument("--rows", type=int, default=100)
+    cascade.add_argument("--entity", default="width")
+    cascade.add_argument("--backend", choices=["pytesseract", "tesserocr"], default="pytesseract")
+    cascade.set_defaults(func=run_cascade_benchmark)
+
+    startup = subparsers.add_parser("startup", help="start-up time and memory of the driver, OCR and parse processes")
+    startup.add_argument("--repeat", type=int, default=5)
+    startup.set_defaults(func=run_startup_benchmark)
+
+    pipeline = subparsers.add_parser("pipeline", help="per-stage and end-to-end timing and accuracy on synthetic images")
+    pipeline.add_argument("--images", help="directory to render the synthetic images into (default: a temp dir)")
+    pipeline.add_argument("--rows", type=int, default=100)
+    pipeline.add_argument("--seed", type=int, default=0)
+    pipeline.add_argument("--backend", choices=["pytesseract", "tesserocr"], default="pytesseract")
+    pipeline.add_argument("--workers", type=int, default=4)
+    pipeline.add_argument("--latency-ms", type=float, default=0)
+    pipeline.set_defaults(func=run_pipeline_benchmark)
+
+    args = parser.parse_args()
+    args.func(args)
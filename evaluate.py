@@ -0,0 +1,263 @@
+# Scores the pipeline against a labelled CSV (image_link, entity_name,
+# entity_value, like the challenge's train.csv): exact match and F1 per
+# entity_name, plus rows/sec, for one or more OCR configurations side by side.
+#
+#   python evaluate.py train_sample.csv --parse-only --config "" --config cascade=1
+#   python evaluate.py train_sample.csv --ocr-workers 8 --config "" --config decode_scale=2 --save after.json
+#   python evaluate.py train_sample.csv --parse-only --against before.json
+#
+# --parse-only parses the OCR text the store already holds for each
+# configuration (rows without it are left out and counted), so a change to
+# abbreviation_map or the matchers is scored in seconds. Without it every
+# image is downloaded (or taken from the image cache) and OCRed again, and the
+# new text is stored for later --parse-only runs. --save writes the report as
+# JSON; --against puts a saved report (say from before a code change) next to
+# this run's.
+import argparse
+import csv
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import main
+
+
+# Function to load a labelled CSV grouped by image
+def load_labels(labels_filename, limit=None):
+    '''
+    Returns:
+    dict: image_link -> list of (entity_name, expected value) in file order.
+    '''
+    groups = {}
+    with open(labels_filename, newline='', encoding='utf-8') as f:
+        for number, record in enumerate(csv.DictReader(f)):
+            if limit is not None and number >= limit:
+                break
+            groups.setdefault(record['image_link'], []).append((record['entity_name'], record['entity_value']))
+    return groups
+
+
+# Function to put a value in the form predictions and labels are compared in
+def normalise_value(value):
+    '''
+    "16.540 Inch" and "16.54 inch" are the same answer; anything that is not
+    a single number and a unit (say a "[10.0, 20.0] cm" range) is only
+    lowercased and stripped.
+    '''
+    value = ' '.join((value or '').lower().split())
+    match = re.fullmatch(r'(\d+(?:\.\d+)?) (.+)', value)
+    if match is None:
+        return value
+    return f"{float(match.group(1))} {match.group(2)}"
+
+
+# Function to score predictions against labels the way the challenge does
+def score(pairs):
+    '''
+    pairs holds (prediction, label) after normalise_value. A non-empty
+    prediction is a true positive when it equals the label and a false
+    positive otherwise; an empty one is a false negative when there is a
+    label.
+
+    Returns:
+    dict: rows, exact (share of rows where prediction == label), precision,
+    recall and f1.
+    '''
+    true_positives = false_positives = false_negatives = exact = 0
+    for prediction, label in pairs:
+        exact += prediction == label
+        if prediction:
+            if prediction == label:
+                true_positives += 1
+            else:
+                false_positives += 1
+        elif label:
+            false_negatives += 1
+    precision = true_positives / (true_positives + false_positives) if true_positives + false_positives else 0.0
+    recall = true_positives / (true_positives + false_negatives) if true_positives + false_negatives else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {'rows': len(pairs), 'exact': exact / len(pairs) if pairs else 0.0,
+            'precision': precision, 'recall': recall, 'f1': f1}
+
+
+# Function to turn "cascade=1,decode_scale=2" into OCR settings
+def parse_config(text):
+    settings = {}
+    for item in filter(None, (item.strip() for item in text.split(','))):
+        key, _, value = item.partition('=')
+        if key not in main.ocr_settings:
+            raise argparse.ArgumentTypeError(f"unknown OCR setting {key!r}, expected one of {', '.join(main.ocr_settings)}")
+        default = main.ocr_settings[key]
+        if isinstance(default, bool):
+            settings[key] = value.lower() in ('1', 'true', 'yes', 'on')
+        elif isinstance(default, str):
+            settings[key] = value
+        else:
+            settings[key] = None if value.lower() in ('', 'none') else int(value)
+    return text or 'default', settings
+
+
+# Function to parse a batch of (text, entity names) in a worker process
+def parse_batch(batch):
+    return [main.predict_all_from_text(text, entity_names) for text, entity_names in batch]
+
+
+# Function to predict every labelled row from the OCR text already stored for the current configuration
+def predict_from_store(groups, workers, batch_size=200):
+    '''
+    A cascade text that stopped before resolving the image's entities is
+    not what a full run would have read, so it counts as missing too.
+
+    Returns:
+    tuple: ({image_link: predictions}, rows without stored text, rows of
+    those whose cascade text stopped early, seconds spent parsing).
+    '''
+    key = main.ocr_key()
+    store = main.get_ocr_store()
+    links, batch, batches = [], [], []
+    missing = unresolved = 0
+    for image_link, labels in groups.items():
+        entity_names = [entity_name for entity_name, _ in labels]
+        entry = store.get_entry(image_link, key)
+        text_in_image = main.stored_text(entry, list(dict.fromkeys(entity_names)))
+        if text_in_image is None:
+            missing += len(labels)
+            if entry is not None:
+                unresolved += len(labels)
+            continue
+        links.append(image_link)
+        batch.append((text_in_image, entity_names))
+        if len(batch) == batch_size:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+
+    start = time.perf_counter()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = [predictions for batch_predictions in executor.map(parse_batch, batches)
+                       for predictions in batch_predictions]
+    else:
+        results = [predictions for batch in batches for predictions in parse_batch(batch)]
+    return dict(zip(links, results)), missing, unresolved, time.perf_counter() - start
+
+
+# Function to predict every labelled row by downloading and OCRing its image again
+def predict_with_pipeline(groups, workers, ocr_workers):
+    '''
+    Returns:
+    tuple: ({image_link: predictions}, rows whose image failed, seconds).
+    Failed images are left out, so a flaky download does not count as a
+    wrong answer.
+    '''
+    def predict(item):
+        image_link, labels = item
+        entity_names = [entity_name for entity_name, _ in labels]
+        try:
+            text_in_image = main.get_image_text(image_link, ocr_executor, entity_names=list(dict.fromkeys(entity_names)),
+                                                use_stored=False)
+        except Exception as e:
+            print(f"Error processing image: {image_link}. Error: {e}")
+            return image_link, None
+        return image_link, main.predict_all_from_text(text_in_image, entity_names)
+
+    ocr_executor = main.OcrPool(ocr_workers)
+    # Start the workers before timing so their one-off initialization is not counted
+    list(ocr_executor.map(abs, range(ocr_workers)))
+    start = time.perf_counter()
+    with ocr_executor, ThreadPoolExecutor(max_workers=workers) as executor:
+        predictions = dict(executor.map(predict, groups.items()))
+    seconds = time.perf_counter() - start
+    failed = sum(len(groups[image_link]) for image_link, result in predictions.items() if result is None)
+    return {image_link: result for image_link, result in predictions.items() if result is not None}, failed, seconds
+
+
+# Function to score one configuration
+def evaluate(groups, name, settings, parse_only, workers, ocr_workers):
+    main.configure_ocr(settings)
+    unresolved = 0
+    if parse_only:
+        predictions, skipped, unresolved, seconds = predict_from_store(groups, workers)
+    else:
+        predictions, skipped, seconds = predict_with_pipeline(groups, workers, ocr_workers)
+
+    by_entity = {}
+    for image_link, image_predictions in predictions.items():
+        for (entity_name, label), prediction in zip(groups[image_link], image_predictions):
+            by_entity.setdefault(entity_name, []).append((normalise_value(prediction), normalise_value(label)))
+    rows = sum(len(pairs) for pairs in by_entity.values())
+    return {
+        'name': name,
+        'settings': settings,
+        'ocr_key': main.ocr_key(),
+        'parse_only': parse_only,
+        'rows': rows,
+        'skipped': skipped,
+        'unresolved': unresolved,
+        'seconds': seconds,
+        'rows_per_sec': rows / seconds if seconds > 0 else 0.0,
+        'overall': score([pair for pairs in by_entity.values() for pair in pairs]),
+        'entities': {entity_name: score(pairs) for entity_name, pairs in sorted(by_entity.items())},
+    }
+
+
+# Function to print reports side by side, one column per configuration
+def print_reports(reports):
+    width = max(16, *(len(report['name']) + 2 for report in reports))
+    print(f"{'':32s}" + ''.join(f"{report['name']:>{width}s}" for report in reports))
+    print(f"{'exact / F1':32s}" + ''.join(f"{'':>{width}s}" for _ in reports))
+    entity_names = sorted({entity_name for report in reports for entity_name in report['entities']})
+    for entity_name in entity_names + ['all']:
+        results = [report['overall'] if entity_name == 'all' else report['entities'].get(entity_name)
+                   for report in reports]
+        rows = max(result['rows'] for result in results if result)
+        cells = [f"{result['exact']:.3f} / {result['f1']:.3f}" if result else '-' for result in results]
+        print(f"{entity_name:26s}{rows:6d}" + ''.join(f"{cell:>{width}s}" for cell in cells))
+    print(f"{'rows/sec':32s}" + ''.join(f"{report['rows_per_sec']:>{width}.1f}" for report in reports))
+    for report in reports:
+        if report['skipped']:
+            reason = "had no usable stored OCR text" if report['parse_only'] else "failed"
+            print(f"{report['name']}: {report['skipped']} rows {reason} and are not scored")
+        if report.get('unresolved'):
+            print(f"{report['name']}: {report['unresolved']} of those had a cascade text that stopped before "
+                  f"reaching their entities (run the cascade on them again to score them)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score predictions against a labelled CSV, per entity and per configuration")
+    parser.add_argument('labels', help="CSV with image_link, entity_name and entity_value columns")
+    parser.add_argument('--config', action='append', type=parse_config, default=None,
+                        help="OCR settings as key=value,... (e.g. cascade=1,decode_scale=2); repeat to compare, "
+                             "\"\" is the default configuration")
+    parser.add_argument('--parse-only', action='store_true', help="parse the stored OCR text instead of OCRing again")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="parse processes with --parse-only, otherwise download/dispatch threads")
+    parser.add_argument('--ocr-workers', type=int, default=os.cpu_count(), help="OCR processes")
+    parser.add_argument('--limit', type=int, default=None, help="only the first N rows of the labels")
+    parser.add_argument('--save', default=None, help="write the reports to this JSON file")
+    parser.add_argument('--against', default=None, help="also show the reports saved in this JSON file")
+    args = parser.parse_args()
+
+    groups = load_labels(args.labels, args.limit)
+    defaults = dict(main.ocr_settings)
+    reports = []
+    if args.against:
+        with open(args.against, encoding='utf-8') as f:
+            for report in json.load(f):
+                report['name'] = f"{report['name']} (saved)"
+                reports.append(report)
+
+    for name, settings in args.config or [('default', {})]:
+        print(f"Evaluating {name} on {sum(len(labels) for labels in groups.values())} rows...")
+        reports.append(evaluate(groups, name, dict(defaults, **settings), args.parse_only, args.workers, args.ocr_workers))
+
+    main.get_image_cache().close()
+    main.get_ocr_store().close()
+    print_reports(reports)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump([report for report in reports if not report['name'].endswith('(saved)')], f, indent=2)
+        print(f"Reports saved to: {args.save}")
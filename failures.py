@@ -0,0 +1,288 @@
+import csv
+import heapq
+import itertools
+import math
+import os
+import random
+import socket
+import threading
+import time
+from collections import Counter
+
+
+class ImageDecodeError(ValueError):
+    '''The downloaded bytes are not an image OpenCV can decode.'''
+
+
+class OcrError(RuntimeError):
+    '''Tesseract (or the OCR worker running it) failed on a decoded image.'''
+
+
+class OcrWorkerLost(OcrError):
+    '''The OCR process pool broke (a worker died) while the image was queued or being OCRed.'''
+
+
+class HostUnavailable(RuntimeError):
+    '''The host's circuit is open, so the download was not attempted.'''
+
+    def __init__(self, host, retry_after):
+        if retry_after == math.inf:
+            super().__init__(f"circuit open for {host}, host given up")
+        else:
+            super().__init__(f"circuit open for {host}, retry in {retry_after:.0f}s")
+        self.host = host
+        self.retry_after = retry_after
+
+
+# Function to name the kind of failure behind an exception
+def classify_failure(error):
+    '''
+    Returns:
+    str: 'timeout', 'http', 'network', 'circuit_open', 'decode', 'worker_lost',
+    'ocr' or 'other'.
+    '''
+    if isinstance(error, ImageDecodeError):
+        return 'decode'
+    if isinstance(error, OcrWorkerLost):
+        return 'worker_lost'
+    if isinstance(error, OcrError):
+        return 'ocr'
+    if isinstance(error, HostUnavailable):
+        return 'circuit_open'
+    if isinstance(error, (TimeoutError, socket.timeout)) or isinstance(getattr(error, 'reason', None), (TimeoutError, socket.timeout)):
+        return 'timeout'
+    # urllib's HTTPError has .code, aiohttp's ClientResponseError has .status
+    if isinstance(http_status(error), int):
+        return 'http'
+    if isinstance(error, OSError) or type(error).__module__.startswith('aiohttp'):
+        return 'network'
+    return 'other'
+
+
+def http_status(error):
+    status = getattr(error, 'status', None)
+    return status if isinstance(status, int) else getattr(error, 'code', None)
+
+
+# Function to tell whether trying the same image again later may succeed
+def is_transient(error):
+    kind = classify_failure(error)
+    if kind == 'http':
+        status = http_status(error)
+        return status in (408, 429) or status >= 500
+    if kind == 'circuit_open':
+        return error.retry_after != math.inf
+    # The image itself may be fine: the pool is restarted and it is OCRed again
+    return kind in ('timeout', 'network', 'worker_lost')
+
+
+# Per-host circuit breakers.
+#
+# After failure_threshold transient failures in a row a host's circuit opens
+# and retry_after() tells callers to stay away for cooldown seconds, so a slow
+# or dead host stops holding worker slots. Once that passes, one request is let
+# through: success closes the circuit, failure opens it again for twice as
+# long (up to max_cooldown). A host whose circuit opened max_opens times in a
+# row is given up for the rest of the run (retry_after() is then math.inf).
+class CircuitBreakers:
+    def __init__(self, failure_threshold=5, cooldown=30.0, max_cooldown=300.0, max_opens=4):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_opens = max_opens
+        self.opened = 0
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def retry_after(self, host):
+        '''
+        Return 0 if a request to host may go ahead now, else seconds to wait.
+        '''
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state['open_until'] is None:
+                return 0
+            if state['opens'] >= self.max_opens:
+                return math.inf
+            now = time.monotonic()
+            if now < state['open_until']:
+                return state['open_until'] - now
+            if state['trial']:
+                # Someone else is already testing the host
+                return state['cooldown']
+            state['trial'] = True
+            return 0
+
+    def record_success(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def record_failure(self, host):
+        with self._lock:
+            state = self._hosts.setdefault(host, {'failures': 0, 'open_until': None, 'cooldown': self.cooldown,
+                                                  'trial': False, 'opens': 0})
+            state['failures'] += 1
+            if state['trial']:
+                state['cooldown'] = min(state['cooldown'] * 2, self.max_cooldown)
+            elif state['failures'] < self.failure_threshold or state['open_until'] is not None:
+                return
+            state['trial'] = False
+            state['open_until'] = time.monotonic() + state['cooldown']
+            state['opens'] += 1
+            self.opened += 1
+            if state['opens'] >= self.max_opens:
+                print(f"Giving up on {host} after {state['failures']} failures")
+            else:
+                print(f"Circuit open for {host} for {state['cooldown']:.0f}s after {state['failures']} failures")
+
+
+# Retry queue with exponential backoff.
+#
+# drain() hands out the work items of a source iterator, and retries that
+# are due, as (item, attempt). Every item handed out must be finished with
+# done(), after schedule() if it should be tried again. drain() only ends when
+# the source is exhausted, no retry is waiting and nothing handed out is still
+# being worked on.
+class RetryQueue:
+    def __init__(self, max_attempts=4, base_delay=2.0, max_delay=120.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retried = 0
+        self._heap = []
+        self._order = itertools.count()
+        self._active = 0
+        self._changed = threading.Condition()
+
+    def retry_delay(self, attempt, error):
+        '''
+        Seconds to wait before trying again, or None if the failure is final.
+        '''
+        if not is_transient(error):
+            return None
+        if isinstance(error, HostUnavailable):
+            # Spread the waiting rows over a second so they do not all wake at once
+            return error.retry_after + random.uniform(0, 1.0)
+        if attempt >= self.max_attempts:
+            return None
+        # Jitter keeps the rows of one failing host from all coming back at once
+        return min(self.base_delay * 2 ** (attempt - 1), self.max_delay) * random.uniform(0.5, 1.0)
+
+    def retry(self, item, attempt, error):
+        '''
+        Schedule item again if error is worth retrying; False if the failure is final.
+        '''
+        delay = self.retry_delay(attempt, error)
+        if delay is None:
+            return False
+        # Waiting out an open circuit does not use up one of the item's attempts
+        self.schedule(item, attempt if isinstance(error, HostUnavailable) else attempt + 1, delay)
+        return True
+
+    def schedule(self, item, attempt, delay):
+        with self._changed:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._order), item, attempt))
+            self.retried += 1
+            self._changed.notify_all()
+
+    def done(self):
+        with self._changed:
+            self._active -= 1
+            self._changed.notify_all()
+
+    def pending(self):
+        with self._changed:
+            return len(self._heap)
+
+    def _pop_due(self):
+        # Called with the condition held
+        if self._heap and self._heap[0][0] <= time.monotonic():
+            _, _, item, attempt = heapq.heappop(self._heap)
+            self._active += 1
+            return item, attempt
+        return None
+
+    def drain(self, items):
+        items = iter(items)
+        source_done = False
+        while True:
+            with self._changed:
+                due = self._pop_due()
+            if due is not None:
+                yield due
+                continue
+
+            if not source_done:
+                item = next(items, None)
+                if item is None:
+                    source_done = True
+                    continue
+                with self._changed:
+                    self._active += 1
+                yield item, 1
+                continue
+
+            with self._changed:
+                due = self._pop_due()
+                if due is None:
+                    if not self._heap and self._active == 0:
+                        return
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._changed.wait(timeout)
+                    continue
+            yield due
+
+
+# Append-only CSV of every failed attempt, one line per row of test.csv.
+#
+# final is 1 when the row was given up on (it was written with an empty
+# prediction); main.py --retry-failed runs those rows again, unless a later run
+# already got them through (see load_failed_indices).
+class FailureLog:
+    FIELDS = ['index', 'image_link', 'entity_name', 'kind', 'attempt', 'final', 'error']
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a', newline='', encoding='utf-8')
+        # Plain \n like result_sink's ResultWriter
+        self._writer = csv.writer(self._file, lineterminator='\n')
+        if new_file:
+            self._writer.writerow(self.FIELDS)
+
+    def record(self, rows, image_link, kind, attempt, error, final):
+        with self._lock:
+            for row in rows:
+                self._writer.writerow([row['index'], image_link, row['entity_name'], kind, attempt, int(final),
+                                       f"{type(error).__name__}: {error}"])
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# Function to load the indices of rows a previous run gave up on
+def load_failed_indices(path, output_filename=None):
+    '''
+    Every give-up also wrote an empty prediction, so with output_filename a
+    row written there more often than it was given up on was got through by
+    a later run and is left out.
+    '''
+    gave_up = Counter()
+    if not os.path.exists(path):
+        return set()
+    with open(path, newline='', encoding='utf-8') as f:
+        for record in csv.DictReader(f):
+            if record['final'] == '1' and record['index'].isdigit():
+                gave_up[int(record['index'])] += 1
+    if output_filename is None or not gave_up or not os.path.exists(output_filename):
+        return set(gave_up)
+
+    written = Counter()
+    with open(output_filename, newline='', encoding='utf-8') as f:
+        for record in csv.reader(f):
+            if record and record[0].isdigit() and int(record[0]) in gave_up:
+                written[int(record[0])] += 1
+    return {index for index, count in gave_up.items() if written[index] <= count}
@@ -0,0 +1,175 @@
+import asyncio
+import queue
+import threading
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+
+from failures import HostUnavailable, is_transient
+
+
+# Marks the end of the download stream on the results queue
+DONE = object()
+
+
+# Asynchronous download stage.
+#
+# Runs an asyncio event loop on a background thread that downloads image URLs
+# through one pooled aiohttp session (keep-alive connections, a global limit
+# and a per-host limit) and stores them in the ImageCache. Every finished
+# download is put on a bounded queue.Queue as (item, image_path, error), which
+# the OCR stage consumes from ordinary threads; when the queue is full the
+# downloader waits, so downloads never run arbitrarily far ahead of OCR.
+# With a metrics.Metrics, each download's latency is recorded. With
+# failures.CircuitBreakers, hosts whose circuit is open are not contacted and
+# their items come back at once with a HostUnavailable error. With an
+# autotune.ConcurrencyLimit, at most its current limit of downloads (and never
+# more than concurrency) run at once.
+class AsyncImageFetcher:
+    def __init__(self, cache, concurrency=64, per_host=16, queue_size=256, timeout=30, retries=3, delay=3,
+                 metrics=None, breakers=None, limit=None):
+        self.cache = cache
+        self.metrics = metrics
+        self.breakers = breakers
+        self.limit = limit
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.delay = delay
+        self.results = queue.Queue(maxsize=queue_size)
+        self.downloaded = 0
+        self.cache_hits = 0
+        self.failed = 0
+        self._thread = None
+
+    def start(self, items):
+        '''
+        Start downloading in the background. items yields (item, url) pairs.
+        '''
+        self._thread = threading.Thread(target=asyncio.run, args=(self._run(items),), daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        while True:
+            result = self.results.get()
+            if result is DONE:
+                # Leave the marker in place for any other consumer thread
+                self.results.put(DONE)
+                return
+            yield result
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    async def _put(self, result):
+        try:
+            self.results.put_nowait(result)
+        except queue.Full:
+            await asyncio.to_thread(self.results.put, result)
+
+    async def _fetch(self, session, item, url):
+        image_save_path = self.cache.get_path(url)
+        if image_save_path is not None:
+            self.cache_hits += 1
+            await self._put((item, image_save_path, None))
+            return
+
+        host = urlparse(url).netloc
+        if self.breakers is not None:
+            retry_after = self.breakers.retry_after(host)
+            if retry_after > 0:
+                await self._put((item, None, HostUnavailable(host, retry_after)))
+                return
+
+        start = time.perf_counter()
+        for attempt in range(self.retries):
+            try:
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    data = await response.read()
+                image_save_path = await asyncio.to_thread(self.cache.put_bytes, url, data)
+                self.downloaded += 1
+                if self.metrics is not None:
+                    self.metrics.observe('download', time.perf_counter() - start)
+                if self.breakers is not None:
+                    self.breakers.record_success(host)
+                await self._put((item, image_save_path, None))
+                return
+            except Exception as e:
+                if attempt == self.retries - 1:
+                    self.failed += 1
+                    if self.breakers is not None:
+                        # Any answer at all means the host is up
+                        if is_transient(e):
+                            self.breakers.record_failure(host)
+                        else:
+                            self.breakers.record_success(host)
+                    await self._put((item, None, e))
+                    return
+                await asyncio.sleep(self.delay)
+
+    async def _run(self, items):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        in_flight = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        def task_finished(task):
+            tasks.discard(task)
+            in_flight.release()
+            if self.limit is not None:
+                self.limit.release()
+
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                # Pulled on a worker thread, so an items generator that waits (e.g. for
+                # a retry to fall due) does not stall the downloads in flight
+                items = iter(items)
+                while True:
+                    entry = await asyncio.to_thread(next, items, DONE)
+                    if entry is DONE:
+                        break
+                    item, url = entry
+                    await in_flight.acquire()
+                    if self.limit is not None:
+                        # Blocks a thread, not the loop, while the limit is lowered below what is in flight
+                        await asyncio.to_thread(self.limit.acquire)
+                    task = asyncio.create_task(self._fetch(session, item, url))
+                    tasks.add(task)
+                    task.add_done_callback(task_finished)
+                if tasks:
+                    await asyncio.gather(*tasks)
+        finally:
+            await self._put(DONE)
+
+
+# Function to run the download stage and the OCR stage concurrently
+def run_pipelined(items, process_image, on_result, fetcher, ocr_workers=8):
+    '''
+    Download every (item, url) in items with fetcher while ocr_workers threads
+    call process_image(item, image_save_path, error) on the finished downloads.
+    on_result(item, result) is called from the OCR threads. An exception
+    from either is printed and counted, and the thread goes on to the next
+    download.
+    '''
+    fetcher.start(items)
+
+    def ocr_worker():
+        for item, image_save_path, error in fetcher:
+            try:
+                on_result(item, process_image(item, image_save_path, error))
+            except Exception as e:
+                # A dead worker would leave the downloads queued for it unread
+                if fetcher.metrics is not None:
+                    fetcher.metrics.count_error('worker', e)
+                print(f"Error in OCR worker: {type(e).__name__}: {e}")
+
+    workers = [threading.Thread(target=ocr_worker, daemon=True) for _ in range(ocr_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    fetcher.join()
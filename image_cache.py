@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+
+
+# Persistent, content-addressed cache for downloaded product images.
+#
+# Files are keyed by a sha256 of the image URL (so two URLs with the same
+# basename never collide) and laid out as <cache_dir>/<key[:2]>/<key>.
+# index.json records url, size and last access for every entry in LRU order;
+# once the total size goes above max_bytes the least recently used images are
+# evicted. Processes sharing one cache directory (e.g. --shard runs) each
+# write their own index, named by index_name, so none overwrites what the
+# others recorded; every index*.json in the directory is read on startup and
+# the latest access of an image wins. Every file (images and the index) is written to a temp file in the
+# same directory and moved into place with os.replace, so readers never see a
+# half written image, and concurrent requests for the same URL share a single
+# download.
+class ImageCache:
+    def __init__(self, cache_dir, max_bytes=20 * 1024 ** 3, flush_every=200, index_name="index.json"):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.index_path = os.path.join(cache_dir, index_name)
+
+        self._lock = threading.Lock()
+        self._download_locks = {}
+        self._entries = OrderedDict()  # key -> {'url', 'size', 'atime'}, oldest first
+        self._total_bytes = 0
+        self._dirty = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def key_for(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _load_index(self):
+        entries = {}
+        index_names = sorted(name for name in os.listdir(self.cache_dir)
+                             if name.startswith("index") and name.endswith(".json"))
+        for index_name in index_names:
+            try:
+                with open(os.path.join(self.cache_dir, index_name), "r", encoding="utf-8") as f:
+                    for entry in json.load(f).get("entries", []):
+                        if entry.get("atime", 0) >= entries.get(entry["key"], {}).get("atime", 0):
+                            entries[entry["key"]] = entry
+            except (OSError, ValueError) as e:
+                print(f"Image cache index {index_name} unreadable, rebuilding from disk. Error: {str(e)}")
+
+        # Keep only index entries whose file is still on disk, oldest access first
+        for entry in sorted(entries.values(), key=lambda entry: entry.get("atime", 0)):
+            path = self.path_for(entry["key"])
+            if os.path.exists(path):
+                size = os.path.getsize(path)
+                self._entries[entry["key"]] = {"url": entry.get("url"), "size": size, "atime": entry.get("atime", 0)}
+                self._total_bytes += size
+
+        # Adopt files written after the last index flush (e.g. the previous run crashed)
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for item in os.scandir(shard.path):
+                if item.name.startswith(".") or item.name in self._entries:
+                    continue
+                size = item.stat().st_size
+                self._entries[item.name] = {"url": None, "size": size, "atime": item.stat().st_mtime}
+                self._total_bytes += size
+                self._dirty += 1
+
+        self._evict()
+
+    def _write_atomic(self, path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _evict(self):
+        # Caller holds self._lock (or is the constructor)
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, entry = self._entries.popitem(last=False)
+            self._total_bytes -= entry["size"]
+            self._dirty += 1
+            try:
+                os.remove(self.path_for(key))
+            except FileNotFoundError:
+                pass
+
+    def get_path(self, url):
+        '''
+        Return the cached file path for url, or None on a miss.
+        '''
+        key = self.key_for(url)
+        path = self.path_for(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            # Another process sharing the directory (a --shard run) may have evicted it
+            if not os.path.exists(path):
+                del self._entries[key]
+                self._total_bytes -= entry["size"]
+                self._dirty += 1
+                return None
+            entry["atime"] = time.time()
+            self._entries.move_to_end(key)
+            self._dirty += 1
+        return path
+
+    def put_bytes(self, url, data):
+        key = self.key_for(url)
+        path = self.path_for(key)
+        self._write_atomic(path, data)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total_bytes -= old["size"]
+            self._entries[key] = {"url": url, "size": len(data), "atime": time.time()}
+            self._total_bytes += len(data)
+            self._dirty += 1
+            self._evict()
+            should_flush = self._dirty >= self.flush_every
+
+        if should_flush:
+            self.flush()
+        return path
+
+    def fetch(self, url, retries=3, delay=3, timeout=30):
+        '''
+        Return a local path for url, downloading it only if it is not cached yet.
+        '''
+        path = self.get_path(url)
+        if path is not None:
+            return path
+
+        # One download per URL; other threads asking for it wait and then hit the cache
+        key = self.key_for(url)
+        with self._lock:
+            download_lock = self._download_locks.setdefault(key, threading.Lock())
+
+        with download_lock:
+            try:
+                path = self.get_path(url)
+                if path is not None:
+                    return path
+
+                for attempt in range(retries):
+                    try:
+                        with urllib.request.urlopen(url, timeout=timeout) as response:
+                            data = response.read()
+                        return self.put_bytes(url, data)
+                    except Exception:
+                        if attempt == retries - 1:
+                            raise
+                        time.sleep(delay)
+            finally:
+                with self._lock:
+                    self._download_locks.pop(key, None)
+
+    def flush(self):
+        '''
+        Write index.json atomically.
+        '''
+        with self._lock:
+            entries = [{"key": key, **entry} for key, entry in self._entries.items()]
+            self._dirty = 0
+        data = json.dumps({"entries": entries}).encode("utf-8")
+        self._write_atomic(self.index_path, data)
+
+    def close(self):
+        self.flush()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
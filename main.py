@@ -1,236 +1,1014 @@
 import os
-import random
-import pandas as pd
-from PIL import Image
-import pytesseract
-import src.utils
-import re
-import cv2
-
-
-# The mapping of entity to valid units
-entity_unit_map = {
-    'width': {'centimetre', 'foot', 'inch', 'metre', 'millimetre', 'yard'},
-    'depth': {'centimetre', 'foot', 'inch', 'metre', 'millimetre', 'yard'},
-    'height': {'centimetre', 'foot', 'inch', 'metre', 'millimetre', 'yard'},
-    'item_weight': {'gram', 'kilogram', 'microgram', 'milligram', 'ounce', 'pound', 'ton'},
-    'maximum_weight_recommendation': {'gram', 'kilogram', 'microgram', 'milligram', 'ounce', 'pound', 'ton'},
-    'voltage': {'kilovolt', 'millivolt', 'volt'},
-    'wattage': {'kilowatt', 'watt'},
-    'item_volume': {'centilitre', 'cubic foot', 'cubic inch', 'cup', 'decilitre', 'fluid ounce', 'gallon', 'imperial gallon', 'litre', 'microlitre', 'millilitre', 'pint', 'quart'}
+import sqlite3
+import threading
+import functools
+import hashlib
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from image_cache import ImageCache
+from ocr_engine import get_engine, import_pytesseract
+from ocr_store import OcrStore
+from metrics import Metrics, collect_stage_timings, stage
+from failures import (CircuitBreakers, FailureLog, HostUnavailable, ImageDecodeError, OcrError, OcrWorkerLost,
+                      RetryQueue, classify_failure, is_transient, load_failed_indices)
+from urllib.parse import urlparse
+# The unit tables and all text parsing live in units.py, re-exported here
+from units import (OCR_TEXT_REPLACEMENTS, SINGLE_PASS_MIN_ENTITIES, UnitCandidate, abbreviation_map,
+                   compile_unit_matcher, entity_dimension_map, entity_unit_map, extract_entity_value,
+                   extract_number_and_unit, extract_unit_candidates, generate_abbreviation_map,
+                   get_candidate_matcher, get_unit_matcher, lookup_key, match_entity_value, predict_all_from_text,
+                   predict_from_text, select_entity_value, trie_pattern, warm_unit_matchers)
+
+# Heavy modules are imported inside the functions that need them: pandas only
+# in the driver (--reparse, reading test.csv), OpenCV, numpy and
+# pytesseract only where images are decoded or OCRed. A process that imports
+# this module just to parse text, e.g. a parse-only worker, never loads them.
+
+# Applied to pytesseract by init_ocr_worker, in every process that OCRs
+TESSERACT_CMD = os.environ.get("TESSERACT_CMD", r"C:/Program Files/Tesseract-OCR/tesseract.exe")
+
+# Downloaded images are kept across runs, keyed by URL hash (see image_cache.py)
+IMAGE_CACHE_DIR = os.path.join(os.getcwd(), "image_cache")
+IMAGE_CACHE_MAX_BYTES = 20 * 1024 ** 3
+# Each --shard run keeps its own index of the shared cache, see ImageCache
+IMAGE_CACHE_INDEX = "index.json"
+
+image_cache = None
+_image_cache_lock = threading.Lock()
+
+def get_image_cache():
+    global image_cache
+    with _image_cache_lock:
+        if image_cache is None:
+            image_cache = ImageCache(IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_BYTES, index_name=IMAGE_CACHE_INDEX)
+    return image_cache
+
+# Raw OCR text of every image, so parsing changes never need another OCR pass (see ocr_store.py)
+OCR_STORE_PATH = os.path.join(os.getcwd(), "ocr_store.sqlite")
+
+ocr_store = None
+_ocr_store_lock = threading.Lock()
+
+def get_ocr_store():
+    global ocr_store
+    with _ocr_store_lock:
+        if ocr_store is None:
+            ocr_store = OcrStore(OCR_STORE_PATH)
+    return ocr_store
+
+# Near-identical images under different URLs share OCR text (see phash_index.py).
+# Off unless PHASH_THRESHOLD is set (--phash-dedup): the most differing hash bits still counted as the same image.
+PHASH_THRESHOLD = None
+
+phash_index = None
+_phash_index_lock = threading.Lock()
+
+def get_phash_index():
+    global phash_index
+    if PHASH_THRESHOLD is None:
+        return None
+    with _phash_index_lock:
+        if phash_index is None:
+            from phash_index import PerceptualHashIndex
+            phash_index = PerceptualHashIndex(get_ocr_store(), ocr_key(), PHASH_THRESHOLD)
+    return phash_index
+
+# Function to load the dedup thumbnail of an already OCRed image from the image cache
+def load_image_thumbnail(image_sha):
+    from phash_index import decode_thumbnail
+
+    for url in get_ocr_store().urls_for_sha(image_sha):
+        image_path = get_image_cache().get_path(url)
+        if image_path is not None:
+            with open(image_path, 'rb') as f:
+                return decode_thumbnail(f.read())
+    return None
+
+# Anything that changes the OCR text must be part of the OCR store key.
+# Bump PREPROCESS_VERSION whenever the image preprocessing in read_image_text changes.
+OCR_CONFIG = r'--oem 1'
+PREPROCESS_VERSION = 2
+
+# OCR settings. init_ocr_worker applies them in every OCR worker, and the
+# driver sets the same values so its OCR store key matches what workers produce.
+#   decode_scale        1, 2, 4 or 8: let the JPEG/PNG decoder produce a smaller image
+#   target_text_height  downscale further when the text is taller than this (pixels)
+#   text_regions        OCR only the detected text lines instead of the whole image
+#   region_workers      threads OCRing those lines, or the tiles below, in parallel (does not change the text)
+#   cascade             cheap OCR pass first, costlier passes only while no value is found
+#   tile_size           OCR images with a side longer than this as overlapping tiles of at most this size
+#   tile_overlap        pixels shared by neighbouring tiles; should exceed the longest word
+ocr_settings = {
+    'ocr_backend': 'pytesseract',
+    'decode_scale': 1,
+    'target_text_height': None,
+    'text_regions': False,
+    'region_workers': 1,
+    'cascade': False,
+    'tile_size': None,
+    'tile_overlap': 200,
 }
 
-# Abbreviation mappings for various units, each unit can have multiple abbreviations
-abbreviation_map = {
-    'centimetre': ['cm', 'centimeter', 'centimetres', 'centimeters', 'cent', 'cms', 'c.m.', 'cm.', 'centim', '¢m', 'c₥', 'cₘ','em'],
-    'foot': ['ft', 'foot', 'feet', 'ft.', 'feet', 'f.t.', 'ft', 'fe', '′', 'ftm'],
-    'inch': ['in', 'inch', 'inches', 'in.', 'ins', 'inchs', 'i.n.', 'in', '"', '″', 'in'],
-    'metre': ['m', 'meter', 'metres', 'meters', 'mtr', 'met', 'mts', 'mt', 'm.', '₥', 'mₘ'],
-    'millimetre': ['mm', 'millimeter', 'millimetres', 'millimeters', 'mil', 'mms', 'mm.', 'mil.', 'ₘₘ', 'mmₘ'],
-    'yard': ['yd', 'yard', 'yards', 'yds', 'yd.', 'yds', 'ydₘ'],
-    'gram': ['g', 'gram', 'grams', 'gm', 'gms', 'gr', 'grs', '₉', 'gₘ'],
-    'kilogram': ['kg', 'kilo', 'kilogram', 'kilograms', 'kgs', 'klg', 'k.g.', 'kg.', 'ₖ₉', 'kgₘ'],
-    'microgram': ['mcg', 'microgram', 'micrograms', 'mcgs', 'μg', 'ug', 'mc', 'μ₉', 'mcₘ'],
-    'milligram': ['mg', 'milligram', 'milligrams', 'mgs', 'mg.', 'millig', 'ₘ₉', 'mgₘ'],
-    'ounce': ['oz', 'ounce', 'ounces', 'ozs', 'oz.', 'o.z.', '℥'],
-    'pound': ['lb', 'pound', 'pounds', 'lbs', 'lbm', 'lb.', 'pound', 'pds', 'ₗₑ', 'lbₘ'],
-    'ton': ['t', 'ton', 'tons', 'tn', 'tns', 't.', 'tonne', 'ₜ', 'tonₘ'],
-    'kilovolt': ['kv', 'kilovolt', 'kilovolts', 'kvs', 'kV', 'KV', 'ₖV'],
-    'millivolt': ['mv', 'millivolt', 'millivolts', 'mvs', 'mV', 'mV', 'ₘV'],
-    'volt': ['v', 'volt', 'volts', 'vs', 'v.', 'V', 'ₜ'],
-    'kilowatt': ['kw', 'kilowatt', 'kilowatts', 'kws', 'kW', 'KW', 'ₖW'],
-    'watt': ['w', 'watt', 'watts', 'ws', 'w.', 'W', 'ₙ'],
-    'centilitre': ['cl', 'centilitre', 'centilitres', 'cL', 'c.l.', 'cl', 'ₗ'],
-    'cubic foot': ['cu ft', 'cubic foot', 'cubic feet', 'cf', 'cuft', 'ft³', 'ft3'],
-    'cubic inch': ['cu in', 'cubic inch', 'cubic inches', 'ci', 'cuin', 'in³', 'in3'],
-    'cup': ['cup', 'cups', 'c', 'cu', 'cps', 'ₗ'],
-    'decilitre': ['dl', 'decilitre', 'decilitres', 'dL', 'd.l.', 'dl', 'ₗ'],
-    'fluid ounce': ['fl oz', 'fluid ounce', 'fluid ounces', 'floz', 'fl oz', 'f.loz', '℥'],
-    'gallon': ['gal', 'gallon', 'gallons', 'gals', 'gal.', 'gall', 'ₗ'],
-    'imperial gallon': ['imp gal', 'imperial gallon', 'imperial gallons', 'imp.gal', 'imp gal', 'ₗ'],
-    'litre': ['l', 'litre', 'liter', 'litres', 'liters', 'L', 'ltr', 'lt', 'ₗ'],
-    'microlitre': ['μl', 'microlitre', 'microl']}
-
-
-# Function to generate abbreviation map for a specific entity
-def generate_abbreviation_map(entity_key, entity_unit_map, abbreviation_map):
-    valid_units = entity_unit_map.get(entity_key, set())
-    unit_abbreviation_mapping = {}
-    
-    # Loop over the valid units and map their abbreviations
-    for unit in valid_units:
-        if unit in abbreviation_map:
-            for abbrev in abbreviation_map[unit]:
-                unit_abbreviation_mapping[abbrev] = unit
-        # Also include the full unit as valid
-        unit_abbreviation_mapping[unit] = unit
-    
-    return unit_abbreviation_mapping
-
-# Function to map units and extract the number and unit, including decimals
-def extract_number_and_unit(text, valid_units, unit_mapping):
-    text = text.replace('"', 'inch').replace('″', 'inch')
-    text = text.replace("'", 'foot').replace('′', 'foot')  # foot
-    text = text.replace(',', '.')  # Replace comma with decimal point
+def configure_ocr(settings=None):
+    if settings:
+        ocr_settings.update(settings)
 
-    """
-    Extracts numbers followed by units from a given text.
+# Shared-memory slots for handing decoded images to OCR processes (see shm_ring.py).
+# The driver creates it with --shm-slots; every OCR worker attaches the same ring in init_ocr_worker.
+image_ring = None
 
-    Args:
-    text (str): The input text.
-    valid_units (list): A list of valid unit names.
-    unit_mapping (dict): A dictionary mapping unit abbreviations to full names.
+def ocr_key():
+    # Only tiled runs add to the key, so text stored by untiled runs still matches
+    tiles = f"|tiles-{ocr_settings['tile_size']}+{ocr_settings['tile_overlap']}" if ocr_settings['tile_size'] else ''
+    return (f"{ocr_settings['ocr_backend']}|preprocess-v{PREPROCESS_VERSION}"
+            f"|scale-{ocr_settings['decode_scale']}|text-{ocr_settings['target_text_height']}"
+            f"|regions-{ocr_settings['text_regions']}|cascade-{ocr_settings['cascade']}{tiles}|{OCR_CONFIG}")
 
+def init_ocr_worker(tesseract_cmd=None, settings=None, ring_spec=None):
+    '''
+    Initializer for OCR worker processes: tesseract settings, the OCR backend
+    and the per-entity unit tables are set up once instead of on every row.
+    '''
+    global image_ring
+    import cv2
+
+    import_pytesseract().pytesseract.tesseract_cmd = tesseract_cmd or TESSERACT_CMD
+    configure_ocr(settings)
+    if ring_spec is not None:
+        from shm_ring import SharedImageRing
+        image_ring = SharedImageRing.attach(ring_spec)
+    # One worker per core already, so keep tesseract and OpenCV single threaded
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+    cv2.setNumThreads(1)
+    warm_unit_matchers()
+    # Load the model now rather than on the first image
+    get_engine(ocr_settings['ocr_backend'])
+
+# Function to estimate the height of the text in a grayscale image
+def estimate_text_height(gray):
+    '''
+    Median height of the character-sized connected components of an Otsu
+    binarisation, or None when there is nothing that looks like text. Large
+    images are probed on a subsampled view, which is plenty for a median.
+    '''
+    import cv2
+    import numpy as np
+
+    step = max(1, min(gray.shape[:2]) // 400)
+    probe = np.ascontiguousarray(gray[::step, ::step])
+    _, binary = cv2.threshold(probe, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT] * step
+    widths = stats[1:, cv2.CC_STAT_WIDTH] * step
+    image_height = gray.shape[0]
+    # Drop specks and blobs that are far too big or too wide to be characters
+    glyphs = heights[(heights >= 8) & (heights < image_height / 3) & (widths < heights * 3)]
+    if len(glyphs) < 3:
+        return None
+    return float(np.median(glyphs))
+
+# Function to decode downloaded image bytes straight into a grayscale array
+def decode_grayscale(data, decode_scale=1, target_text_height=None):
+    import cv2
+    import numpy as np
+
+    # cv2.imdecode flags that decode straight to grayscale at 1/1, 1/2, 1/4 and 1/8 size
+    flags = {
+        1: cv2.IMREAD_GRAYSCALE,
+        2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    }
+    gray = cv2.imdecode(np.frombuffer(data, np.uint8), flags[decode_scale])
+    if gray is None:
+        raise ImageDecodeError("could not decode image")
+
+    if target_text_height:
+        text_height = estimate_text_height(gray)
+        if text_height is not None and text_height > target_text_height:
+            factor = target_text_height / text_height
+            gray = cv2.resize(gray, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+    return gray
+
+region_executor = None
+_region_executor_lock = threading.Lock()
+
+def get_region_executor():
+    global region_executor
+    with _region_executor_lock:
+        if region_executor is None:
+            region_executor = ThreadPoolExecutor(max_workers=ocr_settings['region_workers'])
+    return region_executor
+
+# Function to OCR one detected text line
+def read_region_text(thresh, box):
+    import cv2
+
+    x, y, w, h = box
+    # A white margin around the crop helps tesseract find the baseline
+    crop = cv2.copyMakeBorder(thresh[y:y + h, x:x + w], 10, 10, 10, 10, cv2.BORDER_CONSTANT, value=255)
+    engine = get_engine(ocr_settings['ocr_backend'])
+    return engine.image_to_string(crop, config=OCR_CONFIG + ' --psm 7').strip()
+
+# Function to split one side of an image into overlapping tile spans
+def tile_spans(length, tile_size, overlap):
+    '''
     Returns:
-    list: A list of extracted number-unit pairs.
-    """
-
-    # Create a regex pattern for the valid units or abbreviations
-    unit_pattern = '|'.join([re.escape(unit) for unit in valid_units] + [re.escape(abbrev) for abbrev in unit_mapping.keys()])
-
-    # Regex to match an integer or decimal number followed by any valid unit or abbreviation
-    pattern = r'(\d+(?:\.\d+)?)\s*([a-zA-Z]+)'
-
-    matches = []
-    for match in re.finditer(pattern, text, re.IGNORECASE):
-        number = match.group(1)
-        unit_abbreviation = match.group(2).lower()
-
-        # Check if the matched unit or abbreviation is valid
-        if unit_abbreviation in unit_mapping:
-            # Convert abbreviation to full unit name
-            full_unit = unit_mapping[unit_abbreviation]
-        elif unit_abbreviation in valid_units:
-            # It's already a valid unit
-            full_unit = unit_abbreviation
+    list: (start, end, core_start, core_end) per tile. The cores split the
+    side between the tiles at the middle of each overlap, so every pixel
+    belongs to the core of exactly one tile.
+    '''
+    if length <= tile_size:
+        return [(0, length, 0, length)]
+    count = -(-(length - overlap) // (tile_size - overlap))
+    starts = [round(i * (length - tile_size) / (count - 1)) for i in range(count)]
+    ends = [start + tile_size for start in starts]
+    cuts = [0] + [(start + end) // 2 for start, end in zip(starts[1:], ends[:-1])] + [length]
+    return list(zip(starts, ends, cuts[:-1], cuts[1:]))
+
+# Function to OCR one tile, keeping only the words centred in its core
+def read_tile_words(thresh, tile):
+    (x0, x1, core_x0, core_x1), (y0, y1, core_y0, core_y1) = tile
+    engine = get_engine(ocr_settings['ocr_backend'])
+    words = []
+    for left, top, width, height, text in engine.image_to_words(thresh[y0:y1, x0:x1], config=OCR_CONFIG):
+        left, top = left + x0, top + y0
+        # A word in an overlap is read by both tiles; only the tile whose core holds its centre keeps it
+        if core_x0 <= left + width / 2 < core_x1 and core_y0 <= top + height / 2 < core_y1:
+            words.append((left, top, width, height, text))
+    return words
+
+# Function to OCR a large thresholded image as overlapping tiles in parallel
+def read_tiled_text(thresh):
+    from text_regions import reading_order_lines
+
+    height, width = thresh.shape[:2]
+    tile_size, overlap = ocr_settings['tile_size'], ocr_settings['tile_overlap']
+    tiles = [(xs, ys) for ys in tile_spans(height, tile_size, overlap) for xs in tile_spans(width, tile_size, overlap)]
+    with stage('tesseract'):
+        if ocr_settings['region_workers'] > 1:
+            tile_words = list(get_region_executor().map(functools.partial(read_tile_words, thresh), tiles))
         else:
-            # No valid unit found, skip this match
-            continue
+            tile_words = [read_tile_words(thresh, tile) for tile in tiles]
+    # Words of one line may come from neighbouring tiles, so rebuild the lines from all of them
+    lines = reading_order_lines([word for words in tile_words for word in words])
+    return '\n'.join(' '.join(word[4] for word in line) for line in lines)
 
-        # Append the matched number and unit
-        matches.append(f"{number} {full_unit}")
+# Function to run OCR on a decoded grayscale image
+def read_image_text(gray):
+    import cv2
 
-    if(len(matches) == 0):
-        return ""
-    
-    return matches[0]
+    with stage('threshold'):
+        thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
+
+    if ocr_settings['text_regions']:
+        from text_regions import detect_text_regions
+        with stage('regions'):
+            lines = detect_text_regions(gray)
+        if lines:
+            boxes = [box for line in lines for box in line]
+            with stage('tesseract'):
+                if ocr_settings['region_workers'] > 1 and len(boxes) > 1:
+                    texts = list(get_region_executor().map(functools.partial(read_region_text, thresh), boxes))
+                else:
+                    texts = [read_region_text(thresh, box) for box in boxes]
+            # Stitch the pieces back together: boxes of a line with spaces, lines with newlines
+            texts = iter(texts)
+            return '\n'.join(' '.join(next(texts) for _ in line) for line in lines)
+
+    if ocr_settings['tile_size'] and max(gray.shape[:2]) > ocr_settings['tile_size']:
+        return read_tiled_text(thresh)
+
+    # pytesseract (a tesseract process per image) or a warm in-process engine, see ocr_engine.py
+    engine = get_engine(ocr_settings['ocr_backend'])
+    with stage('tesseract'):
+        return engine.image_to_string(thresh, config=OCR_CONFIG)
+
+# First cascade pass: sparse text, and only digits, separators and the letters unit spellings use
+CASCADE_WHITELIST = ''.join(sorted(
+    set('0123456789.,')
+    | {char for spellings in abbreviation_map.values() for spelling in spellings for char in spelling if char.isalpha()}
+    | {char.upper() for spellings in abbreviation_map.values() for spelling in spellings for char in spelling if char.isalpha()}
+))
+CASCADE_FAST_CONFIG = f'--oem 1 --psm 11 -c tessedit_char_whitelist={CASCADE_WHITELIST}'
+CASCADE_FAST_MAX_SIDE = 1000
+
+# Function to tell whether an OCR text is enough for the entities asked for, which is where the cascade stops
+def cascade_resolved(text, entity_names=()):
+    '''
+    True when every entity in entity_names has a value in text, or any
+    entity does if none (or all of them) are given.
+    '''
+    entity_names = list(entity_names) or list(entity_unit_map)
+    found = [bool(value) for value in predict_all_from_text(text, entity_names)]
+    return all(found) if len(entity_names) < len(entity_unit_map) else any(found)
 
+# Function to OCR an image with the cascade: cheap pass first, escalating only while values are missing
+def read_image_text_cascade(gray, entity_names=(), resume=None):
+    '''
+    Passes, cheapest first, by tier:
+      fast     downscaled, Otsu threshold, --psm 11 with CASCADE_WHITELIST
+      full     today's pass (read_image_text: full resolution, adaptive threshold)
+      rotated  the thresholded image turned 90, 270 and 180 degrees (three passes)
+    Stops at the first pass after which cascade_resolved(entity_names). The
+    texts of all passes that ran are joined in order, so a value found early
+    is still the first match.
+
+    resume is the (text, passes) an earlier call stopped at, as kept in the
+    OCR store: its text is kept and the cascade carries on from the next
+    pass, which gives the same text as running all those passes again.
 
+    Returns:
+    tuple: (text, name of the resolving tier or 'unresolved', passes run or
+    None once every pass has run).
+    '''
+    import cv2
+
+    engine = get_engine(ocr_settings['ocr_backend'])
+    first = resume[1] if resume is not None else 0
+    texts = [resume[0]] if first else []
+
+    def fast():
+        with stage('threshold'):
+            scale = min(1.0, CASCADE_FAST_MAX_SIDE / max(gray.shape[:2]))
+            small = gray if scale == 1.0 else cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            _, binary = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        with stage('tesseract'):
+            return engine.image_to_string(binary, config=CASCADE_FAST_CONFIG)
+
+    thresholds = []
+
+    def rotated(rotation):
+        if not thresholds:
+            with stage('threshold'):
+                thresholds.append(cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                                        cv2.THRESH_BINARY, 11, 2))
+        with stage('tesseract'):
+            return engine.image_to_string(cv2.rotate(thresholds[0], rotation), config=OCR_CONFIG)
+
+    passes = [('fast', fast), ('full', lambda: read_image_text(gray))] + [
+        ('rotated', functools.partial(rotated, rotation))
+        for rotation in (cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_90_COUNTERCLOCKWISE, cv2.ROTATE_180)]
+    for number in range(first, len(passes)):
+        tier, read = passes[number]
+        texts.append(read())
+        if cascade_resolved('\n'.join(texts), entity_names):
+            return '\n'.join(texts), tier, number + 1 if number + 1 < len(passes) else None
+    return '\n'.join(texts), 'unresolved', None
+
+# OCR one downloaded image; this is what runs inside the OCR process pool
+def ocr_image(image_save_path, entity_names=(), resume=None):
+    '''
+    Read the file once, hash those bytes and decode them in memory, instead
+    of cv2.imread at full colour followed by a grayscale conversion.
 
-pytesseract.pytesseract.tesseract_cmd = r"C:/Program Files/Tesseract-OCR/tesseract.exe"
+    Returns:
+    tuple: (image sha256, OCR text, tier that produced it, cascade passes run
+    or None if the text is complete, seconds per stage).
+    '''
+    with collect_stage_timings() as timings:
+        with open(image_save_path, 'rb') as f:
+            data = f.read()
+        with stage('decode'):
+            gray = decode_grayscale(data, ocr_settings['decode_scale'], ocr_settings['target_text_height'])
+        text_in_image, tier, passes = read_decoded_image(gray, entity_names, resume)
+    return hashlib.sha256(data).hexdigest(), text_in_image, tier, passes, timings
+
+# Function to OCR a decoded grayscale image with the configured passes
+def read_decoded_image(gray, entity_names=(), resume=None):
+    if ocr_settings['cascade']:
+        return read_image_text_cascade(gray, entity_names, resume)
+    return read_image_text(gray), 'full', None
+
+# OCR an image the driver decoded into image_ring; runs inside the OCR process pool
+def ocr_shared_image(ref, entity_names=(), resume=None):
+    '''
+    Returns:
+    tuple: (OCR text, tier that produced it, cascade passes run, seconds per stage).
+    '''
+    with collect_stage_timings() as timings:
+        # The pixels are read straight from shared memory, nothing was pickled
+        with image_ring.read(ref) as gray:
+            text_in_image, tier, passes = read_decoded_image(gray, entity_names, resume)
+    return text_in_image, tier, passes, timings
+
+# Function to decode an image on this thread and OCR it in the process pool through image_ring
+def ocr_through_ring(ocr_executor, image_save_path, entity_names=(), resume=None):
+    '''
+    Same result as ocr_executor.run(ocr_image, ...). Decoding moves out
+    of the OCR processes into the calling (download) thread; put() blocks
+    while every slot is in use, which holds decoding back to the pace of OCR.
+    '''
+    with collect_stage_timings() as timings:
+        with open(image_save_path, 'rb') as f:
+            data = f.read()
+        with stage('decode'):
+            gray = decode_grayscale(data, ocr_settings['decode_scale'], ocr_settings['target_text_height'])
+        with stage('slot_wait'):
+            ref = image_ring.put(gray)
+    if ref is None:
+        # Larger than a slot: the worker decodes this one itself
+        return ocr_executor.run(ocr_image, image_save_path, entity_names, resume)
+    try:
+        text_in_image, tier, passes, worker_timings = ocr_executor.run(ocr_shared_image, ref, entity_names, resume)
+    finally:
+        # Also frees the slot when the worker died holding it
+        image_ring.release(ref)
+    for name, seconds in worker_timings.items():
+        timings[name] = timings.get(name, 0.0) + seconds
+    return hashlib.sha256(data).hexdigest(), text_in_image, tier, passes, timings
+
+# Per-stage latencies, errors and throughput of this run, see metrics.py.
+# Stages timed in OCR worker processes come back with ocr_image's result.
+metrics = Metrics()
+
+# Function to count how an image's text was obtained: 'stored' or the OCR tier
+def record_ocr_tier(tier):
+    metrics.increment(f"text_source:{tier}")
+
+# Downloads retried in place by ImageCache.fetch; the pipeline in __main__ sets 1 and uses its RetryQueue instead
+DOWNLOAD_RETRIES = 3
+
+# Per-host circuit breakers shared by both download paths (see failures.py)
+circuit_breakers = CircuitBreakers()
+
+# With --autotune, autotune.ConcurrencyLimits on how many downloads and OCR
+# calls run at once, which the controller raises and lowers during the run
+download_limit = None
+ocr_limit = None
+
+# Function to download an image unless its host's circuit is open
+def download_image(image_link):
+    image_save_path = get_image_cache().get_path(image_link)
+    if image_save_path is not None:
+        return image_save_path
+
+    host = urlparse(image_link).netloc
+    retry_after = circuit_breakers.retry_after(host)
+    if retry_after > 0:
+        raise HostUnavailable(host, retry_after)
+    try:
+        image_save_path = get_image_cache().fetch(image_link, retries=DOWNLOAD_RETRIES)
+    except Exception as e:
+        # Any answer at all (say a 404) means the host is up
+        if is_transient(e):
+            circuit_breakers.record_failure(host)
+        else:
+            circuit_breakers.record_success(host)
+        raise
+    circuit_breakers.record_success(host)
+    return image_save_path
 
-def predictor(image_link, category_id, entity_name):
+# Function to tell whether an (text, passes) entry of the OCR store answers entity_names
+def stored_text(entry, entity_names=()):
+    '''
+    Returns:
+    str: the stored text when it is complete or, for a cascade that stopped
+    early, when it resolves entity_names; else None.
+    '''
+    if entry is None:
+        return None
+    text, passes = entry
+    if passes is None or (passes > 0 and cascade_resolved(text, entity_names)):
+        return text
+    return None
+
+# Function to get the OCR text of an image, from the OCR store when this configuration already read it
+def get_image_text(image_link, ocr_executor=None, image_save_path=None, entity_names=(), use_stored=True):
     '''
-    Download the image and save it to a specified folder.
+    With use_stored=False the image is always OCRed (the text is still
+    stored), e.g. to time OCR or to score an OCR change (see evaluate.py).
+    A cascade text that stopped before resolving entity_names is picked up
+    where it stopped.
+    '''
+    key = ocr_key()
+    entry = get_ocr_store().get_entry(image_link, key) if use_stored else None
+    text_in_image = stored_text(entry, entity_names)
+    if text_in_image is not None:
+        record_ocr_tier('stored')
+        return text_in_image
+    # passes is 0 for texts stored before passes were recorded, which start over
+    resume = entry if entry is not None and entry[1] else None
+
+    # Download the image, or reuse the copy from a previous run
+    if image_save_path is None:
+        # Failures are counted by kind where they are handled (see finish_group)
+        with download_limit or nullcontext(), metrics.time('download', count_errors=False):
+            image_save_path = download_image(image_link)
+
+    # A near-duplicate of an image that was already OCRed skips tesseract
+    index = get_phash_index() if use_stored and resume is None else None
+    if index is not None:
+        from phash_index import decode_thumbnail, dhash
+        with metrics.time('phash'):
+            with open(image_save_path, 'rb') as f:
+                thumbnail = decode_thumbnail(f.read())
+            image_hash = dhash(thumbnail)
+            match_sha = index.find(image_hash, thumbnail, load_image_thumbnail)
+        if match_sha is not None:
+            text_in_image = stored_text(get_ocr_store().get_entry_by_sha(match_sha, key), entity_names)
+            if text_in_image is not None:
+                record_ocr_tier('phash')
+                try:
+                    get_ocr_store().put_url(image_link, match_sha)
+                except sqlite3.Error as e:
+                    metrics.count_error('store', e)
+                    print(f"Error storing OCR text of {image_link}. Error: {str(e)}")
+                return text_in_image
+
+    with ocr_limit or nullcontext(), metrics.time('ocr', count_errors=False):
+        try:
+            if ocr_executor is not None and image_ring is not None:
+                image_sha, text_in_image, tier, passes, timings = ocr_through_ring(
+                    ocr_executor, image_save_path, entity_names, resume)
+            elif ocr_executor is not None:
+                image_sha, text_in_image, tier, passes, timings = ocr_executor.run(
+                    ocr_image, image_save_path, entity_names, resume)
+            else:
+                image_sha, text_in_image, tier, passes, timings = ocr_image(image_save_path, entity_names, resume)
+        except (ImageDecodeError, OcrWorkerLost):
+            raise
+        except Exception as e:
+            raise OcrError(f"{type(e).__name__}: {e}") from e
+    metrics.observe_all(timings)
+    record_ocr_tier(tier)
+    try:
+        get_ocr_store().put(image_link, image_sha, key, text_in_image, passes)
+        if index is not None:
+            index.add(image_hash, image_sha)
+    except sqlite3.Error as e:
+        # The text is still right for these rows, the image is just OCRed again next run
+        metrics.count_error('store', e)
+        print(f"Error storing OCR text of {image_link}. Error: {str(e)}")
+    return text_in_image
+
+# Function to create the process pool used by --ocr-mode process
+def make_ocr_executor(ocr_workers=None, settings=None, ring=None):
+    '''
+    Workers are started the way they are on Windows, from a fresh
+    interpreter that imports this module, never forked from the driver: the
+    pool starts them on demand while dispatch threads are running, and a
+    fork could inherit a lock one of those threads held (e.g. the import
+    lock of cv2), leaving the worker stuck forever. Where there is a fork
+    server it does the starting, which costs no more than a fork.
+    '''
+    import multiprocessing
+
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=ocr_workers or os.cpu_count(), initializer=init_ocr_worker,
+                               initargs=(TESSERACT_CMD, settings or ocr_settings,
+                                         ring.spec() if ring is not None else None),
+                               mp_context=multiprocessing.get_context(method))
+
+# The process pool used by --ocr-mode process, replaced whenever it breaks.
+#
+# A ProcessPoolExecutor whose worker dies (killed, out of memory, a crash in
+# tesseract or OpenCV) is broken for good: every call in flight and every
+# later submit raises BrokenProcessPool. run() turns that into OcrWorkerLost,
+# which the retry queue treats as transient, and the first caller to see it
+# swaps in a new pool, so the images that were in flight are OCRed again on
+# the next attempt instead of being given up on. With a shared-memory ring the
+# slots the dead workers held are taken back, and the new workers attach to
+# the same ring (make_ocr_executor passes its spec to init_ocr_worker).
+class OcrPool:
+    def __init__(self, ocr_workers=None, settings=None, ring=None):
+        self.ocr_workers = ocr_workers
+        self.settings = settings
+        self.ring = ring
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._executor = make_ocr_executor(ocr_workers, settings, ring)
+
+    def run(self, fn, *args):
+        '''
+        Call fn(*args) in a worker process and return its result.
+        '''
+        executor = self._executor
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool as e:
+            self._replace(executor)
+            raise OcrWorkerLost(f"OCR worker died: {e}") from e
+
+    def _replace(self, broken):
+        with self._lock:
+            if self._executor is not broken:
+                # Another thread got there first
+                return
+            # Waits for the broken pool to end and reap its workers: until then a dead
+            # worker is a zombie that still looks alive to the ring's reclaim()
+            broken.shutdown(wait=True, cancel_futures=True)
+            reclaimed = self.ring.reclaim() if self.ring is not None else 0
+            self._executor = make_ocr_executor(self.ocr_workers, self.settings, self.ring)
+            self.restarts += 1
+        print(f"OCR process pool broke, started a new one (restart {self.restarts})"
+              + (f", {reclaimed} shared-memory slots reclaimed" if self.ring is not None else ""))
+
+    def map(self, fn, *iterables):
+        return self._executor.map(fn, *iterables)
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+# Function to start the --autotune controller on download_limit and ocr_limit
+def start_autotune(ranges, interval, log_path, queue_fill=None):
+    '''
+    ranges maps 'download' and 'ocr' to the (minimum, maximum) the
+    controller keeps each limit within.
+    '''
+    from autotune import ConcurrencyController
+    stages = {name: (limit, *ranges[name]) for name, limit in (('download', download_limit), ('ocr', ocr_limit))
+              if limit is not None}
+    for name, (limit, _, _) in stages.items():
+        metrics.set_gauge(f'{name}_limit', lambda limit=limit: limit.limit)
+    controller = ConcurrencyController(metrics, stages, interval=interval, queue_fill=queue_fill, log_path=log_path)
+    controller.start()
+    return controller
+
+def predictor(image_link, category_id, entity_name, ocr_executor=None):
+    '''
+    Download the image, OCR it and extract the entity value.
+    With ocr_executor (an OcrPool), OCR runs in that process pool.
     '''
     #print(f"Processing: {image_link} | Category: {category_id} | Entity: {entity_name}")
     
     try:
-        download_folder = os.path.join(os.getcwd(), "temp_images")
-        if not os.path.exists(download_folder):
-            #print("Creating temp_images folder")
-            os.makedirs(download_folder)
-        
-        # Download the image using utils.py functions
-        #print("Downloading image")
-        src.utils.download_image(image_link, download_folder)
-        #print(f"Image saved to: {os.path.join(download_folder, os.path.basename(image_link))}")
-        image_save_path = os.path.join(download_folder, os.path.basename(image_link))
-        # Open the image and extract text
-
-        #print("Extracting text from image")
-
-        #image = Image.open(image_save_path)
-        image = cv2.imread(image_save_path)
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-        custom_config = r'--oem 1'
-
-
-        text_in_image = pytesseract.image_to_string(thresh, config=custom_config)
-        print("texttttttttt",text_in_image)
-
-        valid_units = entity_unit_map[entity_name]
-        unit_mapping = generate_abbreviation_map(entity_name, entity_unit_map, abbreviation_map)
-
-        # Extract the number and unit from the text
-        answer = extract_number_and_unit(text_in_image, valid_units, unit_mapping)
-        output_file = "C:/Users/xgadg/Downloads/66e31d6ee96cd_student_resource_3/student_resource 3/dataset/errors.csv"
-
-        # Open the file in append mode
-
-        # with open(output_file, 'a') as f:
-        #     # Check if answer is empty
-        #     if answer == "":
-        #         # Write to file
-        #         f.write(f"\n*****************\ntext_in_image: {text_in_image}, extracted text: {answer}\n,entity_name: {entity_name}, image_link: {image_link}\n*****************\n")
-
-        return answer
-
-        
+        return predict_entities(image_link, [entity_name], ocr_executor)[0]
     
     except Exception as e:
+        metrics.count_error(classify_failure(e), e)
         print(f"Error processing image: {image_link}. Error: {str(e)}")
     
     return ""  # Ignore return value as requested
 
-import os
-import pandas as pd
-import os
-import pandas as pd
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-def process_row(row, previous_results, output_filename):
-    index = row['index']
-    image_link = row['image_link']
-    category_id = row['group_id']
-    entity_name = row['entity_name']
-
-    # Check if the index already exists in previous results
-    if index in previous_results['index'].values:
-        print(f"Index {index} already processed, skipping.")
-        return index, None  # Skip this index
-
-    # Process the row and get the prediction
-    prediction = predictor(image_link, category_id, entity_name)
-
-    # Append the new result to the output file
-    with open(output_filename, 'a') as f:
-        f.write(f"{index},{prediction}\n")
+# Function to predict several entities of one image from a single download and OCR
+def predict_entities(image_link, entity_names, ocr_executor=None, image_save_path=None):
+    '''
+    Returns:
+    list: one prediction per name in entity_names.
+    Failures are raised, see failures.classify_failure for what they can be.
+    '''
+    # Open the image and extract text
+    text_in_image = get_image_text(image_link, ocr_executor, image_save_path, list(dict.fromkeys(entity_names)))
+    with metrics.time('parse'):
+        return predict_all_from_text(text_in_image, entity_names)
+
+import argparse
+from result_sink import ResultWriter
+
+# Function to write the predictions of all rows that share one image
+def write_group(rows, predictions, result_writer):
+    for row, prediction in zip(rows, predictions):
+        # Hand the result to the single writer thread
+        result_writer.put(row['index'], prediction)
+    metrics.increment('empty_predictions', sum(1 for prediction in predictions if not prediction))
+    metrics.row_done(len(rows))
+
+# Function to write a group's predictions, or to retry or give up on it when its image failed
+def finish_group(image_link, rows, attempt, result_writer, retry_queue, failure_log, predictions=None, error=None):
+    try:
+        if error is None:
+            # Every row after the first reuses the image's text instead of its own download and OCR
+            metrics.increment('ocr_calls_saved', len(rows) - 1)
+            write_group(rows, predictions, result_writer)
+            return
+
+        kind = classify_failure(error)
+        metrics.count_error(kind, error)
+        retried = retry_queue.retry((image_link, rows), attempt, error)
+        failure_log.record(rows, image_link, kind, attempt, error, final=not retried)
+        if retried:
+            return
+        print(f"Error processing image: {image_link}. Error: {str(error)}")
+        metrics.increment('failed_rows', len(rows))
+        write_group(rows, [""] * len(rows), result_writer)
+    finally:
+        retry_queue.done()
+
+# Function called as each fused-mode group finishes, so an exception raised outside finish_group is not lost
+def check_group(future):
+    try:
+        future.result()
+    except Exception as e:
+        metrics.count_error('worker', e)
+        print(f"Error in worker: {type(e).__name__}: {e}")
 
-    #print(f"Processed index {index} with prediction: {prediction}")
-    return index, prediction
+def process_group(group, attempt, result_writer, retry_queue, failure_log, ocr_executor=None):
+    image_link, rows = group
+    try:
+        # Download and OCR the image once, then parse its text for every row
+        predictions = predict_entities(image_link, [row['entity_name'] for row in rows], ocr_executor)
+    except Exception as e:
+        finish_group(image_link, rows, attempt, result_writer, retry_queue, failure_log, error=e)
+        return None
+    finish_group(image_link, rows, attempt, result_writer, retry_queue, failure_log, predictions)
+
+    #print(f"Processed {len(rows)} rows of {image_link}")
+    return predictions
+
+# OCR stage of the async pipeline: the image has already been downloaded by the fetcher
+def process_downloaded_group(item, image_save_path, error, result_writer, retry_queue, failure_log, ocr_executor=None):
+    (image_link, rows), attempt = item
+    if error is None:
+        try:
+            predictions = predict_entities(image_link, [row['entity_name'] for row in rows], ocr_executor,
+                                           image_save_path)
+        except Exception as e:
+            error = e
+    if error is not None:
+        finish_group(image_link, rows, attempt, result_writer, retry_queue, failure_log, error=error)
+        return None
+    finish_group(image_link, rows, attempt, result_writer, retry_queue, failure_log, predictions)
+    return predictions
+
+# Function to regenerate every prediction from stored OCR text, without downloading or OCRing
+def reparse_predictions(test_filename, output_filename, key):
+    import pandas as pd
+
+    entries = dict(get_ocr_store().iter_entries(key))
+    if os.path.exists(output_filename):
+        os.remove(output_filename)
+
+    missing = unresolved = 0
+    with ResultWriter(output_filename) as result_writer:
+        for chunk in pd.read_csv(test_filename, chunksize=50000):
+            for index, image_link, entity_name in zip(chunk['index'], chunk['image_link'], chunk['entity_name']):
+                entry = entries.get(image_link)
+                # A cascade that stopped before finding this entity is no answer for it
+                text_in_image = stored_text(entry, [entity_name])
+                if text_in_image is None:
+                    missing += entry is None
+                    unresolved += entry is not None
+                    result_writer.put(index, "")
+                else:
+                    result_writer.put(index, extract_entity_value(text_in_image, entity_name))
+    print(f"Reparsed {result_writer.written} rows, {missing} without stored OCR text, "
+          f"{unresolved} whose stored cascade text stopped before reaching their entity")
 
 if __name__ == "__main__":
+    # Only the driver reads test.csv (pandas, through scheduler.py)
+    from scheduler import count_rows, iter_pending_groups, parse_shard, run_bounded
+    from autotune import ConcurrencyLimit, parse_range
+
     DATASET_FOLDER = "C:/Users/xgadg/Downloads/66e31d6ee96cd_student_resource_3/student_resource 3/dataset"
-    output_filename = os.path.join(DATASET_FOLDER, 'test_out.csv')
 
-    # Initialize previous results as an empty DataFrame if the file does not exist or is empty
-    if os.path.exists(output_filename) and os.path.getsize(output_filename) > 0:
-        previous_results = pd.read_csv(output_filename)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset-folder', default=DATASET_FOLDER)
+    parser.add_argument('--mode', choices=['async', 'fused'], default='async',
+                        help="async: separate download and OCR stages; fused: each thread downloads then OCRs")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="threads for --mode fused (default: same as the OCR dispatching threads)")
+    parser.add_argument('--ocr-mode', choices=['thread', 'process'], default='process',
+                        help="thread: OCR in the worker threads; process: OCR in a process pool")
+    parser.add_argument('--ocr-backend', choices=['pytesseract', 'tesserocr'], default='pytesseract',
+                        help="tesserocr keeps a warm tesseract engine per OCR worker")
+    parser.add_argument('--ocr-workers', type=int, default=None,
+                        help="OCR threads or processes (default: 8 threads, or one process per core)")
+    parser.add_argument('--decode-scale', type=int, choices=[1, 2, 4, 8], default=1,
+                        help="decode images at 1/N size")
+    parser.add_argument('--target-text-height', type=int, default=None,
+                        help="downscale images whose text is taller than this many pixels")
+    parser.add_argument('--text-regions', action='store_true',
+                        help="detect text lines first and OCR only those")
+    parser.add_argument('--region-workers', type=int, default=1,
+                        help="threads per OCR worker for --text-regions and --tile-size")
+    parser.add_argument('--cascade', action='store_true',
+                        help="cheap whitelisted OCR pass first, full and rotated passes only when it finds nothing")
+    parser.add_argument('--tile-size', type=int, default=None,
+                        help="OCR images with a side longer than this many pixels as overlapping tiles, "
+                             "--region-workers at a time")
+    parser.add_argument('--tile-overlap', type=int, default=200,
+                        help="pixels shared by neighbouring tiles, so no word is only ever seen cut in half")
+    parser.add_argument('--phash-dedup', action='store_true',
+                        help="reuse the OCR text of a near-identical image seen under another URL")
+    parser.add_argument('--phash-threshold', type=int, default=6,
+                        help="most of the 256 perceptual hash bits that may differ for --phash-dedup "
+                             "(matches are then confirmed on pixels)")
+    parser.add_argument('--shm-slots', type=int, default=0,
+                        help="with --ocr-mode process: decode images in the dispatching threads and hand them to "
+                             "the OCR processes through this many shared-memory slots (0: workers decode)")
+    parser.add_argument('--shm-slot-mb', type=float, default=16,
+                        help="size of one --shm-slots slot; larger images fall back to decoding in the worker")
+    parser.add_argument('--download-concurrency', type=int, default=64)
+    parser.add_argument('--per-host', type=int, default=16)
+    parser.add_argument('--queue-size', type=int, default=256)
+    parser.add_argument('--chunksize', type=int, default=10000, help="rows read from test.csv at a time")
+    parser.add_argument('--shard', type=parse_shard, default=None, metavar='K/N',
+                        help="only process rows with index %% N == K, into test_out.K-of-N.csv; "
+                             "combine the shards with sort_output.py")
+    parser.add_argument('--reparse', action='store_true',
+                        help="rebuild predictions into test_out_reparsed.csv from the OCR store only")
+    parser.add_argument('--max-attempts', type=int, default=4,
+                        help="tries per image before its rows get an empty prediction; only timeouts, "
+                             "network errors, HTTP 408/429/5xx, open circuits and dead OCR workers are retried")
+    parser.add_argument('--retry-delay', type=float, default=2.0,
+                        help="first retry delay in seconds, doubling on every further attempt")
+    parser.add_argument('--circuit-cooldown', type=float, default=30.0,
+                        help="seconds a host is left alone after 5 failures in a row, doubling while it keeps failing")
+    parser.add_argument('--retry-failed', action='store_true',
+                        help="also redo the rows the failure log says a previous run gave up on")
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help="images submitted but not finished in --mode fused (default: 4 per thread)")
+    parser.add_argument('--autotune', action='store_true',
+                        help="raise and lower how many downloads and OCR calls run at once during the run, "
+                             "to maximise rows/sec; decisions go to autotune.jsonl in the dataset folder")
+    parser.add_argument('--autotune-interval', type=float, default=15.0, help="seconds between --autotune decisions")
+    parser.add_argument('--download-range', type=parse_range, default=None, metavar='MIN:MAX',
+                        help="downloads at once that --autotune may use (default: 2:64, or up to "
+                             "--download-concurrency if higher); MIN:MIN pins it")
+    parser.add_argument('--ocr-range', type=parse_range, default=None, metavar='MIN:MAX',
+                        help="OCR calls at once that --autotune may use (default: 1 to twice the cores); "
+                             "MIN:MIN pins it")
+    parser.add_argument('--metrics-file', default=None,
+                        help="append a JSON metrics snapshot per line here (default: metrics.jsonl in the dataset folder)")
+    parser.add_argument('--metrics-interval', type=float, default=30.0, help="seconds between metrics snapshots")
+    parser.add_argument('--progress-interval', type=float, default=10.0, help="seconds between console summaries")
+    args = parser.parse_args()
+    if args.tile_size and args.tile_overlap >= args.tile_size:
+        parser.error("--tile-overlap must be smaller than --tile-size")
+
+    test_filename = os.path.join(args.dataset_folder, 'test.csv')
+    # The driver keys the OCR store on these settings, whichever process runs OCR
+    configure_ocr({
+        'ocr_backend': args.ocr_backend,
+        'decode_scale': args.decode_scale,
+        'target_text_height': args.target_text_height,
+        'text_regions': args.text_regions,
+        'region_workers': args.region_workers,
+        'cascade': args.cascade,
+        'tile_size': args.tile_size,
+        'tile_overlap': args.tile_overlap,
+    })
+    if args.phash_dedup:
+        PHASH_THRESHOLD = args.phash_threshold
+    if args.shard is not None:
+        IMAGE_CACHE_INDEX = f'index.{args.shard[0]}-of-{args.shard[1]}.json'
+    if args.reparse:
+        reparse_predictions(test_filename, os.path.join(args.dataset_folder, 'test_out_reparsed.csv'), ocr_key())
+        get_ocr_store().close()
+        raise SystemExit(0)
+
+    # With --autotune the OCR threads or processes are sized for the top of
+    # the range and ocr_limit decides how many of them are used at a time
+    ocr_workers = args.ocr_workers
+    if args.autotune:
+        ranges = {
+            'download': args.download_range or (2, max(64, args.download_concurrency)),
+            'ocr': args.ocr_range or (1, 2 * os.cpu_count()),
+        }
+        ocr_start = args.ocr_workers or (os.cpu_count() if args.ocr_mode == 'process' else 8)
+        ocr_limit = ConcurrencyLimit(min(max(ocr_start, ranges['ocr'][0]), ranges['ocr'][1]))
+        ocr_workers = ranges['ocr'][1]
+
+    ocr_executor = None
+    if args.ocr_mode == 'process':
+        ocr_processes = ocr_workers or os.cpu_count()
+        if args.shm_slots:
+            from shm_ring import SharedImageRing
+            image_ring = SharedImageRing(args.shm_slots, int(args.shm_slot_mb * 1024 ** 2))
+        if image_ring is not None or PHASH_THRESHOLD is not None:
+            # The dispatch threads decode too. OpenCV is imported here, before any of them
+            # runs: its import swaps sys.path for a moment, and a worker started meanwhile
+            # would copy that sys.path (see make_ocr_executor)
+            import cv2
+        ocr_executor = OcrPool(ocr_processes, ring=image_ring)
+        # Enough dispatching threads to keep every OCR process busy
+        ocr_threads = ocr_processes * 2
     else:
-        # Create an empty DataFrame for previous results
-        previous_results = pd.DataFrame(columns=['index', 'prediction'])
-
-    # Load the test CSV
-    test = pd.read_csv(os.path.join(DATASET_FOLDER, 'test.csv'))
-    total_rows = len(test)
-    
-    # Create a ThreadPoolExecutor to handle multithreading
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = []
-        
-        # Submit tasks to the executor
-        for _, row in test.iterrows():
-            futures.append(executor.submit(process_row, row, previous_results, output_filename))
-
-        # Process the results
-        processed_rows = 0
-        for future in as_completed(futures):
-            index, prediction = future.result()
-            if prediction is not None:
-                processed_rows += 1
-                progress_percentage = (processed_rows / total_rows) * 100
-                print(f"Progress: {processed_rows}/{total_rows} ({progress_percentage:.2f}%)")
+        init_ocr_worker()
+        ocr_threads = ocr_workers or 8
 
+    if args.shard is None:
+        output_filename = os.path.join(args.dataset_folder, 'test_out.csv')
+    else:
+        output_filename = os.path.join(args.dataset_folder, f'test_out.{args.shard[0]}-of-{args.shard[1]}.csv')
+
+    # All writes to the output go through one batching writer thread, which
+    # also loads the indices already written by a previous run
+    result_writer = ResultWriter(output_filename)
+    done_indices = frozenset(result_writer.completed)
+
+    # Every failed attempt is logged with its rows' indices; transient failures are retried with
+    # backoff from the retry queue, so a worker never sleeps on a failing download
+    failures_filename = os.path.join(
+        args.dataset_folder, 'failures.csv' if args.shard is None else f'failures.{args.shard[0]}-of-{args.shard[1]}.csv')
+    if args.retry_failed:
+        done_indices = done_indices - load_failed_indices(failures_filename, output_filename)
+    failure_log = FailureLog(failures_filename)
+    retry_queue = RetryQueue(max_attempts=args.max_attempts, base_delay=args.retry_delay)
+    circuit_breakers.cooldown = args.circuit_cooldown
+    DOWNLOAD_RETRIES = 1
+    print(f"Resuming with {len(done_indices)} rows already processed")
+
+    # Stream test.csv instead of loading it, with the rows of a chunk grouped by image
+    pending_groups = iter_pending_groups(test_filename, done_indices, chunksize=args.chunksize, shard=args.shard)
+    metrics.total_rows = count_rows(test_filename, args.shard) - len(done_indices)
+    metrics_filename = args.metrics_file or os.path.join(
+        args.dataset_folder, 'metrics.jsonl' if args.shard is None else f'metrics.{args.shard[0]}-of-{args.shard[1]}.jsonl')
+    metrics.set_gauge('writer_queue', result_writer.pending)
+    metrics.set_gauge('retry_queue', retry_queue.pending)
+    if image_ring is not None:
+        metrics.set_gauge('shm_slots_used', image_ring.used)
+    # Replaces the per-row progress line with a rate-limited summary and ETA
+    metrics.start_reporting(metrics_filename, args.metrics_interval, args.progress_interval)
+    autotune_filename = os.path.join(
+        args.dataset_folder, 'autotune.jsonl' if args.shard is None else f'autotune.{args.shard[0]}-of-{args.shard[1]}.jsonl')
+    controller = None
+
+    if args.mode == 'fused':
+        workers = args.workers or ocr_threads
+        if args.autotune:
+            # Each thread downloads then OCRs, so with enough threads for both tops
+            # the two limits decide how many do either at a time. Downloads start
+            # from the thread count fused mode would otherwise have.
+            download_start = args.workers or (2 * ocr_start if args.ocr_mode == 'process' else ocr_start)
+            download_limit = ConcurrencyLimit(min(max(download_start, ranges['download'][0]), ranges['download'][1]))
+            workers = args.workers or ranges['download'][1] + ranges['ocr'][1]
+            controller = start_autotune(ranges, args.autotune_interval, autotune_filename)
+        # Create a ThreadPoolExecutor to handle multithreading
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Only a fixed window of rows is submitted at any time
+            run_bounded(
+                retry_queue.drain(pending_groups),
+                lambda work: executor.submit(process_group, *work, result_writer, retry_queue, failure_log,
+                                             ocr_executor),
+                check_group,
+                max_in_flight=args.max_in_flight or workers * 4,
+            )
+    else:
+        # In-place retries would hold a download slot; failures come back through the retry queue
+        from fetcher import AsyncImageFetcher, run_pipelined
+        download_concurrency = args.download_concurrency
+        if args.autotune:
+            download_limit = ConcurrencyLimit(min(max(download_concurrency, ranges['download'][0]),
+                                                  ranges['download'][1]))
+            download_concurrency = ranges['download'][1]
+        fetcher = AsyncImageFetcher(get_image_cache(), concurrency=download_concurrency,
+                                    per_host=args.per_host, queue_size=args.queue_size, retries=1,
+                                    metrics=metrics, breakers=circuit_breakers, limit=download_limit)
+        metrics.set_gauge('download_queue', fetcher.results.qsize)
+        if args.autotune:
+            controller = start_autotune(ranges, args.autotune_interval, autotune_filename,
+                                        queue_fill=lambda: fetcher.results.qsize() / fetcher.results.maxsize)
+        process_image = functools.partial(process_downloaded_group, result_writer=result_writer,
+                                          retry_queue=retry_queue, failure_log=failure_log, ocr_executor=ocr_executor)
+
+        def groups_to_download():
+            # Images already OCRed with this configuration skip the fetcher
+            key = ocr_key()
+            for (image_link, rows), attempt in retry_queue.drain(pending_groups):
+                entity_names = [row['entity_name'] for row in rows]
+                text_in_image = stored_text(get_ocr_store().get_entry(image_link, key), entity_names)
+                if text_in_image is not None:
+                    record_ocr_tier('stored')
+                    finish_group(image_link, rows, attempt, result_writer, retry_queue, failure_log,
+                                 predict_all_from_text(text_in_image, entity_names))
+                else:
+                    yield ((image_link, rows), attempt), image_link
+
+        groups_and_links = groups_to_download()
+        run_pipelined(groups_and_links, process_image, lambda item, predictions: None, fetcher,
+                      ocr_workers=ocr_threads)
+        print(f"Downloaded {fetcher.downloaded}, cache hits {fetcher.cache_hits}, failed {fetcher.failed}")
+
+    if controller is not None:
+        controller.stop()
+        limits = controller.limits()
+        print(f"Autotune made {controller.decisions} changes (see {autotune_filename}) and ended at "
+              f"download limit {limits['download']}, OCR limit {limits['ocr']}; pin them with "
+              f"--autotune --download-range {limits['download']}:{limits['download']} "
+              f"--ocr-range {limits['ocr']}:{limits['ocr']}")
+    result_writer.close()
+    failure_log.close()
+    if ocr_executor is not None:
+        ocr_executor.shutdown()
+        if ocr_executor.restarts:
+            print(f"OCR process pool restarted {ocr_executor.restarts} times after a worker died")
+    get_image_cache().close()
+    get_ocr_store().close()
+    snapshot = metrics.stop_reporting(metrics_filename)
+    if image_ring is not None:
+        print(f"Shared-memory handoff: waited for a free slot {image_ring.waits} times, "
+              f"{image_ring.reclaimed} slots reclaimed from dead workers")
+        image_ring.close()
+    print("OCR text by source: " + ", ".join(
+        f"{name.split(':', 1)[1]} {count}" for name, count in sorted(snapshot['counters'].items())
+        if name.startswith('text_source:')))
+    print(f"OCR calls saved by sharing an image's text across its rows: {snapshot['counters'].get('ocr_calls_saved', 0)}")
+    if phash_index is not None:
+        print(f"Perceptual-hash dedup: {phash_index.hits} of {phash_index.lookups} images "
+              f"({100 * phash_index.hit_rate():.1f}%) reused a near-duplicate's OCR text, "
+              f"{phash_index.rejected} hash matches rejected on pixels")
+    print(f"Empty predictions: {snapshot['counters'].get('empty_predictions', 0)}, "
+          f"{snapshot['counters'].get('failed_rows', 0)} of them given up on after failures (see {failures_filename}); "
+          f"{retry_queue.retried} retries, {circuit_breakers.opened} circuits opened")
+    if snapshot['errors']:
+        print("Errors: " + ", ".join(f"{name} {count}" for name, count in sorted(snapshot['errors'].items())))
     print(f"Results appended to: {output_filename}")
@@ -0,0 +1,239 @@
+import bisect
+import json
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+# Histogram bucket upper bounds in seconds: 1 ms doubling up to ~2 minutes
+LATENCY_BUCKETS = [0.001 * 2 ** i for i in range(18)]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the percentile, so never an underestimate
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + [self.max], self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'max': self.max,
+        }
+
+
+# Stage timings collected on the current thread (see collect_stage_timings)
+_local = threading.local()
+
+
+@contextmanager
+def stage(name):
+    '''
+    Time a block as stage `name`. Outside collect_stage_timings this costs
+    two perf_counter calls and records nothing, so it can stay in code that
+    also runs in OCR worker processes.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = getattr(_local, 'timings', None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+@contextmanager
+def collect_stage_timings():
+    '''
+    Collect every stage() timed on this thread inside the block into a dict
+    of stage -> seconds, which can be sent back from a worker process.
+    '''
+    previous = getattr(_local, 'timings', None)
+    _local.timings = {}
+    try:
+        yield _local.timings
+    finally:
+        _local.timings = previous
+
+
+# Run-wide metrics: per-stage latency histograms, error counts by type,
+# counters, queue depth gauges and rows/sec with an ETA. Observations only
+# take a lock and bump a bucket; start_reporting() adds one background thread
+# that appends a JSON snapshot to export_path every export_interval seconds and
+# prints a one-line summary at most every console_interval seconds.
+class Metrics:
+    def __init__(self, total_rows=None):
+        self.total_rows = total_rows
+        self.started = time.monotonic()
+        self.rows_done = 0
+        self.histograms = {}
+        self.errors = Counter()
+        self.counters = Counter()
+        self.gauges = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def observe(self, stage_name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage_name)
+            if histogram is None:
+                histogram = self.histograms[stage_name] = Histogram()
+            histogram.observe(seconds)
+
+    def observe_all(self, timings):
+        for stage_name, seconds in timings.items():
+            self.observe(stage_name, seconds)
+
+    @contextmanager
+    def time(self, stage_name, count_errors=True):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            if count_errors:
+                self.count_error(stage_name, e)
+            raise
+        finally:
+            self.observe(stage_name, time.perf_counter() - start)
+
+    def count_error(self, stage_name, error):
+        with self._lock:
+            self.errors[f"{stage_name}:{type(error).__name__}"] += 1
+
+    def increment(self, name, count=1):
+        with self._lock:
+            self.counters[name] += count
+
+    def row_done(self, count=1):
+        with self._lock:
+            self.rows_done += count
+
+    def stage_totals(self):
+        '''
+        Returns:
+        tuple: (rows done, {stage: (count, total seconds)}), both since the
+        start, so the difference between two calls covers the time between.
+        '''
+        with self._lock:
+            return self.rows_done, {name: (histogram.count, histogram.total)
+                                    for name, histogram in self.histograms.items()}
+
+    def set_gauge(self, name, read):
+        '''
+        Register a callable (e.g. a queue's qsize) sampled at every report.
+        '''
+        self.gauges[name] = read
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            rows_done = self.rows_done
+            histograms = {name: histogram.summary() for name, histogram in self.histograms.items()}
+            errors = dict(self.errors)
+            counters = dict(self.counters)
+        gauges = {}
+        for name, read in self.gauges.items():
+            try:
+                gauges[name] = read()
+            except Exception:
+                gauges[name] = None
+
+        rate = rows_done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total_rows is not None and rate > 0:
+            eta = max(self.total_rows - rows_done, 0) / rate
+        return {
+            'time': time.time(),
+            'elapsed': elapsed,
+            'rows_done': rows_done,
+            'total_rows': self.total_rows,
+            'rows_per_sec': rate,
+            'eta_seconds': eta,
+            'stages': histograms,
+            'errors': errors,
+            'counters': counters,
+            'gauges': gauges,
+        }
+
+    def format_summary(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        parts = [f"rows {snapshot['rows_done']}"]
+        if snapshot['total_rows']:
+            parts[0] += f"/{snapshot['total_rows']} ({100 * snapshot['rows_done'] / snapshot['total_rows']:.2f}%)"
+        parts.append(f"{snapshot['rows_per_sec']:.1f} rows/s")
+        if snapshot['eta_seconds'] is not None:
+            parts.append(f"ETA {format_duration(snapshot['eta_seconds'])}")
+        for name, summary in sorted(snapshot['stages'].items()):
+            parts.append(f"{name} p50 {1000 * summary['p50']:.0f}ms p95 {1000 * summary['p95']:.0f}ms")
+        if snapshot['errors']:
+            parts.append(f"errors {sum(snapshot['errors'].values())}")
+        for name, value in sorted(snapshot['gauges'].items()):
+            parts.append(f"{name} {value}")
+        return " | ".join(parts)
+
+    def start_reporting(self, export_path=None, export_interval=30.0, console_interval=10.0):
+        def report():
+            last_export = last_console = time.monotonic()
+            while not self._stop.wait(min(export_interval, console_interval)):
+                now = time.monotonic()
+                snapshot = self.snapshot()
+                if now - last_console >= console_interval:
+                    print(self.format_summary(snapshot))
+                    last_console = now
+                if export_path and now - last_export >= export_interval:
+                    self.export(export_path, snapshot)
+                    last_export = now
+
+        self._thread = threading.Thread(target=report, daemon=True)
+        self._thread.start()
+
+    def export(self, export_path, snapshot=None):
+        with open(export_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(snapshot or self.snapshot()) + '\n')
+
+    def stop_reporting(self, export_path=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        snapshot = self.snapshot()
+        if export_path:
+            self.export(export_path, snapshot)
+        print(self.format_summary(snapshot))
+        return snapshot
+
+
+# Function to format seconds as 1h02m03s
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m{seconds:02d}s"
+    if minutes:
+        return f"{minutes}m{seconds:02d}s"
+    return f"{seconds}s"
@@ -0,0 +1,163 @@
+import shlex
+import sys
+import threading
+
+
+# OCR backends. Both take a grayscale/binary numpy array and a tesseract style
+# config string ("--oem 1 --psm 11 -c tessedit_char_whitelist=...") and return
+# the recognised text (image_to_string) or its words with their boxes
+# (image_to_words).
+#
+#   pytesseract  forks the tesseract binary for every image and goes through a
+#                temp image and a temp text file (today's behaviour).
+#   tesserocr    keeps a warm TessBaseAPI per thread (so one per OCR worker
+#                process); the LSTM model is loaded once and the pixels are
+#                handed over from memory, with no temp files.
+OCR_BACKENDS = ('pytesseract', 'tesserocr')
+
+
+def parse_tesseract_config(config):
+    '''
+    Split a tesseract command line config into (oem, psm, variables).
+    '''
+    oem, psm, variables = None, None, {}
+    tokens = shlex.split(config or '')
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token == '--oem':
+            oem = int(tokens[i + 1])
+            i += 2
+        elif token == '--psm':
+            psm = int(tokens[i + 1])
+            i += 2
+        elif token == '-c':
+            key, _, value = tokens[i + 1].partition('=')
+            variables[key] = value
+            i += 2
+        else:
+            raise ValueError(f"Unsupported tesseract config option: {token}")
+    return oem, psm, variables
+
+
+# Function to read the words out of tesseract's TSV output
+def parse_tsv_words(tsv):
+    '''
+    Returns:
+    list: (left, top, width, height, text) of every recognised word.
+    '''
+    words = []
+    for line in tsv.splitlines():
+        fields = line.split('\t')
+        # Word rows are level 5; the header and page/block/line rows are skipped
+        if len(fields) < 12 or fields[0] != '5' or not fields[11].strip():
+            continue
+        left, top, width, height = (int(value) for value in fields[6:10])
+        words.append((left, top, width, height, fields[11].strip()))
+    return words
+
+
+# Function to import pytesseract without the pandas import it does on its own
+def import_pytesseract():
+    '''
+    pytesseract imports pandas whenever it is installed, only to offer
+    DataFrame output, which is never asked for here. In an OCR worker that
+    is about half of its start-up time and memory, so unless pandas is
+    already loaded, pytesseract is imported as if it were not installed.
+    sys.modules is shared by every thread, so that is only done while this
+    is the process's one thread, as in a worker initializer (init_ocr_worker);
+    a thread importing pandas meanwhile would otherwise fail.
+    '''
+    if 'pandas' in sys.modules or 'pytesseract' in sys.modules or threading.active_count() > 1:
+        import pytesseract
+        return pytesseract
+    sys.modules['pandas'] = None
+    try:
+        import pytesseract
+    finally:
+        del sys.modules['pandas']
+    return pytesseract
+
+
+class PytesseractEngine:
+    def image_to_string(self, image, config=''):
+        return import_pytesseract().image_to_string(image, config=config)
+
+    def image_to_words(self, image, config=''):
+        return parse_tsv_words(import_pytesseract().image_to_data(image, config=config))
+
+
+class TesserocrEngine:
+    def __init__(self, lang='eng'):
+        try:
+            import tesserocr
+        except ImportError as e:
+            raise ImportError("The tesserocr OCR backend needs the tesserocr package (pip install tesserocr)") from e
+        self.tesserocr = tesserocr
+        self.lang = lang
+        self.apis = {}  # one warm API per --oem value, the engine mode is fixed at init
+
+    def _api(self, oem):
+        api = self.apis.get(oem)
+        if api is None:
+            if oem is None:
+                api = self.tesserocr.PyTessBaseAPI(lang=self.lang)
+            else:
+                api = self.tesserocr.PyTessBaseAPI(lang=self.lang, oem=self.tesserocr.OEM(oem))
+            self.apis[oem] = api
+        return api
+
+    def image_to_string(self, image, config=''):
+        return self._recognise(image, config, lambda api: api.GetUTF8Text())
+
+    def image_to_words(self, image, config=''):
+        return self._recognise(image, config, lambda api: parse_tsv_words(api.GetTSVText(0)))
+
+    def _recognise(self, image, config, read):
+        import numpy as np
+
+        oem, psm, variables = parse_tesseract_config(config)
+        api = self._api(oem)
+
+        # Variables stick to the API, so put the previous values back afterwards
+        previous = {key: api.GetVariableAsString(key) for key in variables}
+        for key, value in variables.items():
+            api.SetVariable(key, value)
+        api.SetPageSegMode(self.tesserocr.PSM(psm if psm is not None else 3))
+        try:
+            image = np.ascontiguousarray(image)
+            height, width = image.shape[:2]
+            bytes_per_pixel = 1 if image.ndim == 2 else image.shape[2]
+            api.SetImageBytes(image.tobytes(), width, height, bytes_per_pixel, image.strides[0])
+            return read(api)
+        finally:
+            for key, value in previous.items():
+                api.SetVariable(key, value or '')
+            api.Clear()
+
+    def close(self):
+        for api in self.apis.values():
+            api.End()
+        self.apis.clear()
+
+
+_engines = threading.local()
+
+
+def get_engine(backend='pytesseract'):
+    '''
+    Return this thread's engine for backend, creating it on first use.
+    '''
+    engines = getattr(_engines, 'engines', None)
+    if engines is None:
+        engines = _engines.engines = {}
+    engine = engines.get(backend)
+    if engine is None:
+        if backend == 'pytesseract':
+            engine = PytesseractEngine()
+        elif backend == 'tesserocr':
+            engine = TesserocrEngine()
+        else:
+            raise ValueError(f"Unknown OCR backend: {backend}")
+        engines[backend] = engine
+    return engine
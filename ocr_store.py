@@ -0,0 +1,144 @@
+import sqlite3
+import threading
+
+
+# Persistent store of raw OCR output.
+#
+# OCR text is keyed by (sha256 of the image bytes, ocr_key), where ocr_key
+# names the backend, preprocessing version and tesseract config that produced
+# it, so a change to any of those never serves stale text. A second table maps
+# image URLs to image hashes, which lets a rerun (or --reparse) go from a row of
+# test.csv straight to its text without downloading or OCRing anything. A URL
+# whose image was matched to a near-duplicate (see phash_index.py) maps to the
+# hash of that near-duplicate, whose text it shares.
+#
+# Text from the OCR cascade may stop early, once the entities asked for were
+# resolved; passes records how many of its passes ran, so a later request for
+# other entities can carry on from there (NULL: the text is complete). A
+# partial text never replaces a more complete one.
+# SQLite in WAL mode. Several processes (e.g. --shard runs) may share one
+# store: an uncommitted write holds the database's write lock, so writes are
+# committed as they are made by default (cheap with synchronous=NORMAL, which
+# does not sync the WAL on every commit), and other writers wait at most
+# busy_timeout for it. commit_every > 1 batches commits for a store that only
+# one process writes.
+class OcrStore:
+    def __init__(self, path, commit_every=1):
+        self.path = path
+        self.commit_every = commit_every
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=30000')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS images (url TEXT PRIMARY KEY, image_sha TEXT NOT NULL)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS ocr_text ('
+            ' image_sha TEXT NOT NULL, ocr_key TEXT NOT NULL, text TEXT NOT NULL, passes INTEGER,'
+            ' PRIMARY KEY (image_sha, ocr_key)) WITHOUT ROWID')
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(ocr_text)')]
+        if 'passes' not in columns:
+            # Stores written before passes was recorded: their cascade texts may be partial,
+            # with no telling how far they got, so those are redone from the first pass
+            self._conn.execute('ALTER TABLE ocr_text ADD COLUMN passes INTEGER')
+            self._conn.execute("UPDATE ocr_text SET passes = 0 WHERE ocr_key LIKE '%|cascade-True|%'")
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS image_phash (image_sha TEXT PRIMARY KEY, phash TEXT NOT NULL) WITHOUT ROWID')
+        self._conn.commit()
+
+    def get_text(self, url, ocr_key):
+        '''
+        Return the stored OCR text for the image at url under ocr_key, or None.
+        '''
+        entry = self.get_entry(url, ocr_key)
+        return None if entry is None else entry[0]
+
+    def get_entry(self, url, ocr_key):
+        '''
+        Returns:
+        tuple: (text, passes) for the image at url under ocr_key, or None;
+        passes is None when the text is complete.
+        '''
+        with self._lock:
+            return self._conn.execute(
+                'SELECT t.text, t.passes FROM images i JOIN ocr_text t ON t.image_sha = i.image_sha'
+                ' WHERE i.url = ? AND t.ocr_key = ?', (url, ocr_key)).fetchone()
+
+    def put(self, url, image_sha, ocr_key, text, passes=None):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO images (url, image_sha) VALUES (?, ?)', (url, image_sha))
+            # A complete text always replaces; a partial one only a partial one with fewer passes
+            self._conn.execute(
+                'INSERT INTO ocr_text (image_sha, ocr_key, text, passes) VALUES (?, ?, ?, ?)'
+                ' ON CONFLICT (image_sha, ocr_key) DO UPDATE SET text = excluded.text, passes = excluded.passes'
+                ' WHERE excluded.passes IS NULL OR (ocr_text.passes IS NOT NULL AND excluded.passes > ocr_text.passes)',
+                (image_sha, ocr_key, text, passes))
+            self._count_write()
+
+    def get_text_by_sha(self, image_sha, ocr_key):
+        entry = self.get_entry_by_sha(image_sha, ocr_key)
+        return None if entry is None else entry[0]
+
+    def get_entry_by_sha(self, image_sha, ocr_key):
+        with self._lock:
+            return self._conn.execute('SELECT text, passes FROM ocr_text WHERE image_sha = ? AND ocr_key = ?',
+                                      (image_sha, ocr_key)).fetchone()
+
+    def urls_for_sha(self, image_sha, limit=3):
+        with self._lock:
+            rows = self._conn.execute('SELECT url FROM images WHERE image_sha = ? LIMIT ?', (image_sha, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def put_url(self, url, image_sha):
+        '''
+        Point url at the text already stored for another image.
+        '''
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO images (url, image_sha) VALUES (?, ?)', (url, image_sha))
+            self._count_write()
+
+    def put_phash(self, image_sha, phash):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO image_phash (image_sha, phash) VALUES (?, ?)', (image_sha, phash))
+            self._count_write()
+
+    def iter_phashes(self, ocr_key):
+        '''
+        Yield (image sha256, perceptual hash as hex) for every image with text under ocr_key.
+        '''
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT p.image_sha, p.phash FROM image_phash p JOIN ocr_text t ON t.image_sha = p.image_sha'
+                ' WHERE t.ocr_key = ?', (ocr_key,)).fetchall()
+        yield from rows
+
+    def _count_write(self):
+        # Called with the lock held
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self._conn.commit()
+            self._pending = 0
+
+    def iter_entries(self, ocr_key):
+        '''
+        Yield (url, (text, passes)) for every URL with stored text under ocr_key,
+        passes as in get_entry.
+        '''
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT i.url, t.text, t.passes FROM images i JOIN ocr_text t ON t.image_sha = i.image_sha'
+                ' WHERE t.ocr_key = ?', (ocr_key,)).fetchall()
+        for url, text, passes in rows:
+            yield url, (text, passes)
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
@@ -0,0 +1,132 @@
+import threading
+
+import cv2
+import numpy as np
+
+from failures import ImageDecodeError
+
+
+# Side of the difference hash grid; the hash has DHASH_SIZE ** 2 bits
+DHASH_SIZE = 16
+
+
+# Function to decode image bytes into the small grayscale copy dedup works on
+def decode_thumbnail(data, side=512):
+    # Half-size decode is plenty for a thumbnail and much cheaper than a full one
+    gray = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if gray is None:
+        raise ImageDecodeError("could not decode image")
+    height, width = gray.shape
+    factor = min(side / max(height, width), 1.0)
+    thumbnail = cv2.resize(gray, (max(round(width * factor), 1), max(round(height * factor), 1)),
+                           interpolation=cv2.INTER_AREA)
+    # Takes the edge off resampling and recompression differences
+    return cv2.GaussianBlur(thumbnail, (3, 3), 0)
+
+
+# Function to compute the difference hash (dHash) of a thumbnail
+def dhash(thumbnail, hash_size=DHASH_SIZE, margin=4):
+    '''
+    Shrink to (hash_size + 1) x hash_size pixels and keep one bit per pair of
+    horizontal neighbours: is the right one brighter by more than margin grey
+    levels. Without the margin, the many flat white areas of product images
+    turn into coin flips under recompression.
+
+    Returns:
+    int: the hash, hash_size ** 2 bits.
+    '''
+    small = cv2.resize(thumbnail, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = ((small[:, 1:] - small[:, :-1]) > margin).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+# Function to check that two thumbnails show the same image, not just the same layout
+def same_image(thumbnail, other, max_block_difference=48, blocks=32):
+    '''
+    A hash cannot tell two spec sheets of one template apart when only the
+    numbers differ, so compare the pixels: the mean difference of every one
+    of blocks x blocks cells must stay below max_block_difference. A changed
+    number lights up its cells; recompression or resizing does not.
+    '''
+    height, width = thumbnail.shape
+    other_height, other_width = other.shape
+    if abs(height / width - other_height / other_width) > 0.02:
+        return False
+    other = cv2.resize(other, (width, height), interpolation=cv2.INTER_AREA)
+    difference = cv2.absdiff(thumbnail, other)
+    cells = cv2.resize(difference, (min(blocks, width), min(blocks, height)), interpolation=cv2.INTER_AREA)
+    return int(cells.max()) < max_block_difference
+
+
+# Index of perceptual hashes of images that already have OCR text.
+#
+# find() returns an image whose hash is within threshold differing bits of a
+# new one and whose pixels pass same_image. Hashes are split into
+# threshold + 1 bands; two hashes that differ in at most threshold bits must
+# agree exactly on at least one band, so only images sharing a band with the
+# query are compared. The hashes live in the OCR store (image_phash table), so
+# the index carries over between runs; only images with text under ocr_key
+# are loaded.
+class PerceptualHashIndex:
+    def __init__(self, store, ocr_key, threshold=6, hash_bits=DHASH_SIZE ** 2, max_checks=3):
+        self.store = store
+        self.threshold = threshold
+        self.hash_bits = hash_bits
+        self.max_checks = max_checks
+        self.lookups = 0
+        self.hits = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+        band_count = min(threshold + 1, hash_bits)
+        bounds = [hash_bits * i // band_count for i in range(band_count + 1)]
+        self._bands = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self._tables = [{} for _ in self._bands]
+        for image_sha, hash_hex in store.iter_phashes(ocr_key):
+            # Hashes of another size are not comparable
+            if len(hash_hex) == hash_bits // 4:
+                self._index(int(hash_hex, 16), image_sha)
+
+    def _index(self, value, image_sha):
+        for table, (start, mask) in zip(self._tables, self._bands):
+            table.setdefault((value >> start) & mask, []).append((value, image_sha))
+
+    def _candidates(self, value):
+        distances = {}
+        with self._lock:
+            for table, (start, mask) in zip(self._tables, self._bands):
+                for other, image_sha in table.get((value >> start) & mask, ()):
+                    distance = bin(value ^ other).count('1')
+                    if distance <= self.threshold:
+                        distances[image_sha] = distance
+        return sorted(distances, key=distances.get)
+
+    def find(self, value, thumbnail, load_thumbnail):
+        '''
+        Return the sha256 of an indexed image that is the same picture, or None.
+        load_thumbnail(image_sha) gives that image's decode_thumbnail, or None
+        when its bytes are no longer around.
+        '''
+        match = None
+        for image_sha in self._candidates(value)[:self.max_checks]:
+            other = load_thumbnail(image_sha)
+            if other is None:
+                continue
+            if same_image(thumbnail, other):
+                match = image_sha
+                break
+            with self._lock:
+                self.rejected += 1
+        with self._lock:
+            self.lookups += 1
+            if match is not None:
+                self.hits += 1
+        return match
+
+    def add(self, value, image_sha):
+        with self._lock:
+            self._index(value, image_sha)
+        self.store.put_phash(image_sha, format(value, f'0{self.hash_bits // 4}x'))
+
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else 0.0
@@ -0,0 +1,132 @@
+import csv
+import os
+import queue
+import threading
+import time
+
+
+# Function to load the indices that already have a prediction in the output file
+def load_done_indices(output_filename):
+    '''
+    Read the output CSV once into a set, so the resume check per row is O(1).
+    '''
+    done = set()
+    if not os.path.exists(output_filename):
+        return done
+    with open(output_filename, newline='', encoding='utf-8') as f:
+        for record in csv.reader(f):
+            # Skips the header
+            if record and record[0].isdigit():
+                done.add(int(record[0]))
+    return done
+
+
+# Function to drop a partially written last line left behind by a crash
+def repair_tail(output_filename):
+    if not os.path.exists(output_filename):
+        return
+    with open(output_filename, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        # Walk back to the last complete line
+        position = size
+        while position > 0:
+            step = min(4096, position)
+            f.seek(position - step)
+            block = f.read(step)
+            newline = block.rfind(b'\n')
+            if newline != -1:
+                f.truncate(position - step + newline + 1)
+                return
+            position -= step
+        f.truncate(0)
+
+
+# Single writer for test_out.csv.
+#
+# Worker threads hand results over with put(); one background thread batches
+# them into the CSV with csv.writer (so predictions are escaped), flushes every
+# flush_interval seconds and fsyncs at most every fsync_interval seconds. The
+# file is only ever appended to by this thread, so lines cannot interleave, and
+# a crash loses at most the last unsynced batch, which the next run redoes.
+class ResultWriter:
+    def __init__(self, output_filename, batch_size=512, flush_interval=1.0, fsync_interval=10.0):
+        self.output_filename = output_filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+
+        repair_tail(output_filename)
+        self.completed = load_done_indices(output_filename)
+        self.written = 0
+
+        self._queue = queue.Queue()
+        self._stop = object()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, index, prediction):
+        if self._error is not None:
+            raise self._error
+        self._queue.put((index, prediction))
+
+    def is_done(self, index):
+        return index in self.completed
+
+    def pending(self):
+        '''
+        Number of results handed over but not yet written.
+        '''
+        return self._queue.qsize()
+
+    def _run(self):
+        try:
+            new_file = not os.path.exists(self.output_filename) or os.path.getsize(self.output_filename) == 0
+            with open(self.output_filename, 'a', newline='', encoding='utf-8') as f:
+                # Plain \n like the lines a run before this writer appended
+                writer = csv.writer(f, lineterminator='\n')
+                if new_file:
+                    writer.writerow(['index', 'prediction'])
+                last_fsync = time.monotonic()
+                stopping = False
+                while not stopping:
+                    batch = []
+                    deadline = time.monotonic() + self.flush_interval
+                    while len(batch) < self.batch_size:
+                        try:
+                            item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                        except queue.Empty:
+                            break
+                        if item is self._stop:
+                            stopping = True
+                            break
+                        batch.append(item)
+
+                    if batch:
+                        writer.writerows(batch)
+                        f.flush()
+                        self.completed.update(index for index, _ in batch)
+                        self.written += len(batch)
+                    if stopping or time.monotonic() - last_fsync >= self.fsync_interval:
+                        os.fsync(f.fileno())
+                        last_fsync = time.monotonic()
+        except Exception as e:
+            self._error = e
+            print(f"Result writer failed: {str(e)}")
+
+    def close(self):
+        self._queue.put(self._stop)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,87 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import pandas as pd
+
+
+# Function to parse a --shard value 'k/N' into (k, N)
+def parse_shard(value):
+    '''
+    Shard k of N owns the rows whose index % N == k, so N machines or
+    processes started with 0/N .. N-1/N cover test.csv exactly once.
+    '''
+    try:
+        shard, shard_count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must look like k/N, got {value!r}")
+    if shard_count < 1 or not 0 <= shard < shard_count:
+        raise argparse.ArgumentTypeError(f"shard k/N needs 0 <= k < N, got {value!r}")
+    return shard, shard_count
+
+
+# Function to count the data rows of a CSV without loading it
+def count_rows(csv_path, shard=None):
+    if shard is not None:
+        shard, shard_count = shard
+        return sum(int((chunk['index'] % shard_count == shard).sum())
+                   for chunk in pd.read_csv(csv_path, usecols=['index'], chunksize=100000))
+    with open(csv_path, 'rb') as f:
+        return max(sum(1 for _ in f) - 1, 0)
+
+
+# Function to stream the rows of test.csv that still need a prediction, a chunk at a time
+def iter_pending_chunks(csv_path, done=(), chunksize=10000, shard=None):
+    '''
+    Yield lists of rows (as dicts, like the pandas rows process_row used to
+    get) in file order, chunksize rows at a time, skipping indices in done.
+    With shard (k, N), only the rows of that shard (see parse_shard).
+    '''
+    done = done if isinstance(done, (set, frozenset)) else set(done)
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+        if shard is not None:
+            chunk = chunk[chunk['index'] % shard[1] == shard[0]]
+        if done:
+            chunk = chunk[~chunk['index'].isin(done)]
+        yield chunk.to_dict('records')
+
+
+# Function to stream the rows of test.csv that still need a prediction
+def iter_pending_rows(csv_path, done=(), chunksize=10000, shard=None):
+    for rows in iter_pending_chunks(csv_path, done, chunksize, shard):
+        yield from rows
+
+
+# Function to stream pending rows grouped by image, so each image is downloaded and OCRed once
+def iter_pending_groups(csv_path, done=(), chunksize=10000, shard=None):
+    '''
+    Yield (image_link, rows) with the rows of a chunk that share an image,
+    in order of each image's first row. Grouping is per chunk to keep memory
+    flat; an image whose rows span chunks is read from the OCR store the
+    second time.
+    '''
+    for rows in iter_pending_chunks(csv_path, done, chunksize, shard):
+        groups = {}
+        for row in rows:
+            groups.setdefault(row['image_link'], []).append(row)
+        yield from groups.items()
+
+
+# Function to run submit(row) for every row with at most max_in_flight futures outstanding
+def run_bounded(rows, submit, on_done, max_in_flight):
+    '''
+    Pull rows lazily and keep a fixed window of submitted futures, calling
+    on_done(future) as each one finishes. Memory stays flat however many
+    rows there are, unlike submitting every row up front.
+    '''
+    in_flight = set()
+    for row in rows:
+        if len(in_flight) >= max_in_flight:
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                on_done(future)
+        in_flight.add(submit(row))
+
+    while in_flight:
+        finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in finished:
+            on_done(future)
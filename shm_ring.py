@@ -0,0 +1,208 @@
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# Slot states, kept in the shared header so every process sees them
+FREE, WRITTEN, READING = 0, 1, 2
+
+# Header columns per slot: state, pid of the process holding the slot, generation
+HEADER_FIELDS = 3
+
+# What a worker gets instead of the pixels: a few integers that pickle to nothing
+SlotRef = namedtuple('SlotRef', ['index', 'generation', 'shape'])
+
+
+# Function to tell whether a process is still running
+def pid_alive(pid):
+    if sys.platform == 'win32':
+        return _windows_pid_alive(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Exists, just not ours
+        return True
+    return True
+
+
+# Windows has no signal 0: os.kill(pid, 0) there sends CTRL_C_EVENT to the
+# process's console group, so ask for the process's exit code instead
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+STILL_ACTIVE = 259
+ERROR_ACCESS_DENIED = 5
+
+
+def _windows_pid_alive(pid):
+    import ctypes
+    from ctypes import wintypes
+
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    kernel32.OpenProcess.argtypes = (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.GetExitCodeProcess.argtypes = (wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD))
+    kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+    handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+        # Exists, just not ours; anything else means there is no such process
+        return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+    try:
+        exit_code = wintypes.DWORD()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+            return True
+        return exit_code.value == STILL_ACTIVE
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+# Ring of fixed-size image slots in shared memory.
+#
+# The process that creates the ring is the only one that hands out slots:
+# put() copies a grayscale array into a free slot and returns a SlotRef, which
+# is all that travels to the OCR worker. A worker attaches the ring once
+# (attach()) and read() gives it an ndarray on the shared pages themselves, no
+# copy; leaving the block frees the slot. When every slot is taken put()
+# blocks until one frees up, so decoding can never run further ahead of OCR
+# than the ring allows.
+#
+# A slot records the pid of the process holding it. release() frees a slot
+# whatever state it is in (the driver calls it once the OCR future is done,
+# also when the worker died with it), and put() takes back slots whose holder
+# is no longer alive before it waits. The generation is bumped every time a
+# slot is handed out, so a stale SlotRef can never read someone else's image.
+class SharedImageRing:
+    def __init__(self, slots, slot_bytes, name=None, create=True):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        header_bytes = slots * HEADER_FIELDS * 8
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=header_bytes + slots * slot_bytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = create
+        self.header = np.ndarray((slots, HEADER_FIELDS), dtype=np.int64, buffer=self.shm.buf)
+        if create:
+            self.header[:] = 0
+        self._data_offset = header_bytes
+        self._lock = threading.Condition()
+        self.waits = 0
+        self.reclaimed = 0
+
+    @classmethod
+    def attach(cls, spec):
+        '''
+        Attach to a ring created elsewhere; spec is the creator's spec().
+        '''
+        name, slots, slot_bytes = spec
+        return cls(slots, slot_bytes, name=name, create=False)
+
+    def spec(self):
+        return self.shm.name, self.slots, self.slot_bytes
+
+    def _view(self, index, shape):
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf,
+                          offset=self._data_offset + index * self.slot_bytes)
+
+    def _take_free_slot(self):
+        # Called with the lock held
+        free = np.flatnonzero(self.header[:, 0] == FREE)
+        if len(free) == 0:
+            return None
+        index = int(free[0])
+        self.header[index, 0] = WRITTEN
+        self.header[index, 1] = os.getpid()
+        self.header[index, 2] += 1
+        return index
+
+    def put(self, image, timeout=None):
+        '''
+        Copy a 2-D uint8 image into a free slot, waiting while the ring is full.
+
+        Returns:
+        SlotRef: the slot to pass to read(), or None if the image is larger
+        than a slot (or no slot freed up within timeout seconds).
+        '''
+        if image.dtype != np.uint8 or image.ndim != 2 or image.nbytes > self.slot_bytes:
+            return None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+        with self._lock:
+            index = self._take_free_slot()
+            while index is None:
+                if self.reclaim():
+                    index = self._take_free_slot()
+                    continue
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                # Workers free slots from other processes, which cannot notify us, so poll as well
+                self._lock.wait(0.05)
+                index = self._take_free_slot()
+            generation = int(self.header[index, 2])
+        self._view(index, image.shape)[:] = image
+        return SlotRef(index, generation, image.shape)
+
+    @contextmanager
+    def read(self, ref):
+        '''
+        Map the image in slot ref without copying. The array is only valid
+        inside the block: the slot is freed and reused once it is left.
+        '''
+        index = ref.index
+        if self.header[index, 2] != ref.generation or self.header[index, 0] != WRITTEN:
+            raise RuntimeError(f"Shared image slot {index} was reclaimed before it was read")
+        self.header[index, 1] = os.getpid()
+        self.header[index, 0] = READING
+        view = self._view(index, ref.shape)
+        # OCR only ever reads its input; an in-place write would be a bug in another process's image
+        view.flags.writeable = False
+        try:
+            yield view
+        finally:
+            if self.header[index, 2] == ref.generation:
+                self.header[index, 0] = FREE
+
+    def release(self, ref):
+        '''
+        Free slot ref if it still holds that image, whatever happened to its reader.
+        '''
+        with self._lock:
+            if self.header[ref.index, 2] == ref.generation and self.header[ref.index, 0] != FREE:
+                self.header[ref.index, 0] = FREE
+            self._lock.notify()
+
+    def reclaim(self):
+        '''
+        Free the slots held by processes that are no longer alive.
+
+        Returns:
+        int: how many slots were taken back.
+        '''
+        reclaimed = 0
+        with self._lock:
+            for index in np.flatnonzero(self.header[:, 0] != FREE):
+                pid = int(self.header[index, 1])
+                if pid != os.getpid() and not pid_alive(pid):
+                    self.header[index, 0] = FREE
+                    reclaimed += 1
+            self.reclaimed += reclaimed
+        return reclaimed
+
+    def used(self):
+        return int(np.count_nonzero(self.header[:, 0] != FREE))
+
+    def close(self):
+        # The header array is a view on the mapping and must go before it can be closed
+        del self.header
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
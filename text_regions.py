@@ -0,0 +1,85 @@
+import cv2
+import numpy as np
+
+
+# Function to find boxes around lines of text in a grayscale product image
+def detect_text_regions(gray, min_height=8, max_height_fraction=0.5, min_edge_density=0.1, join_width=None, pad=4):
+    '''
+    Morphological gradient + Otsu picks out strong local edges (characters),
+    a wide closing joins neighbouring characters into line blobs, and the
+    external contours of those blobs are filtered down to text-like boxes.
+
+    Returns:
+    list: lines top to bottom, each a list of (x, y, w, h) boxes left to right.
+    '''
+    image_height, image_width = gray.shape[:2]
+    if join_width is None:
+        join_width = max(15, image_width // 40)
+
+    gradient = cv2.morphologyEx(gray, cv2.MORPH_GRADIENT, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+    _, edges = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    lines = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (join_width, 1)))
+    contours, _ = cv2.findContours(lines, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    boxes = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if h < min_height or h > image_height * max_height_fraction or w < h * 0.4:
+            continue
+        # Text lines are dense in edges; photo regions and outlines are not
+        if cv2.countNonZero(edges[y:y + h, x:x + w]) < min_edge_density * w * h:
+            continue
+        x0, y0 = max(x - pad, 0), max(y - pad, 0)
+        x1, y1 = min(x + w + pad, image_width), min(y + h + pad, image_height)
+        boxes.append((x0, y0, x1 - x0, y1 - y0))
+
+    return reading_order_lines(merge_overlapping(boxes))
+
+
+# Function to merge boxes that overlap, so no text is OCRed twice
+def merge_overlapping(boxes):
+    boxes = [list(box) for box in boxes]
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        while boxes:
+            x, y, w, h = boxes.pop()
+            i = 0
+            while i < len(boxes):
+                bx, by, bw, bh = boxes[i]
+                if bx < x + w and x < bx + bw and by < y + h and y < by + bh:
+                    x0, y0 = min(x, bx), min(y, by)
+                    x1, y1 = max(x + w, bx + bw), max(y + h, by + bh)
+                    x, y, w, h = x0, y0, x1 - x0, y1 - y0
+                    boxes.pop(i)
+                    merged = True
+                else:
+                    i += 1
+            result.append([x, y, w, h])
+        boxes = result
+    return [tuple(box) for box in boxes]
+
+
+# Function to group boxes into lines the way a page is read
+def reading_order_lines(boxes):
+    '''
+    Boxes whose vertical centres fall within half a box height of each other
+    belong to the same line; lines go top to bottom, boxes left to right.
+    '''
+    lines = []
+    for box in sorted(boxes, key=lambda box: box[1] + box[3] / 2):
+        centre = box[1] + box[3] / 2
+        if lines and abs(centre - lines[-1]['centre']) <= max(box[3], lines[-1]['height']) / 2:
+            lines[-1]['boxes'].append(box)
+        else:
+            lines.append({'centre': centre, 'height': box[3], 'boxes': [box]})
+    return [sorted(line['boxes'], key=lambda box: box[0]) for line in lines]
+
+
+# Function to report how much of the image the detected lines cover
+def region_area_fraction(lines, gray):
+    covered = np.zeros(gray.shape[:2], dtype=bool)
+    for x, y, w, h in (box for line in lines for box in line):
+        covered[y:y + h, x:x + w] = True
+    return float(covered.mean())
@@ -0,0 +1,327 @@
+import functools
+import re
+from collections import namedtuple
+
+
+# Unit tables and the text side of the pipeline: turning OCR text into
+# "number unit" predictions. Plain Python and re only, so anything that just
+# parses text (say the parse-only workers of evaluate.py) can import it
+# without pulling in OpenCV, tesseract or pandas. main.py re-exports all of it.
+
+
+# The mapping of entity to valid units
+entity_unit_map = {
+    'width': {'centimetre', 'foot', 'inch', 'metre', 'millimetre', 'yard'},
+    'depth': {'centimetre', 'foot', 'inch', 'metre', 'millimetre', 'yard'},
+    'height': {'centimetre', 'foot', 'inch', 'metre', 'millimetre', 'yard'},
+    'item_weight': {'gram', 'kilogram', 'microgram', 'milligram', 'ounce', 'pound', 'ton'},
+    'maximum_weight_recommendation': {'gram', 'kilogram', 'microgram', 'milligram', 'ounce', 'pound', 'ton'},
+    'voltage': {'kilovolt', 'millivolt', 'volt'},
+    'wattage': {'kilowatt', 'watt'},
+    'item_volume': {'centilitre', 'cubic foot', 'cubic inch', 'cup', 'decilitre', 'fluid ounce', 'gallon', 'imperial gallon', 'litre', 'microlitre', 'millilitre', 'pint', 'quart'}
+}
+
+# Abbreviation mappings for various units, each unit can have multiple abbreviations
+abbreviation_map = {
+    'centimetre': ['cm', 'centimeter', 'centimetres', 'centimeters', 'cent', 'cms', 'c.m.', 'cm.', 'centim', '¢m', 'c₥', 'cₘ','em'],
+    'foot': ['ft', 'foot', 'feet', 'ft.', 'feet', 'f.t.', 'ft', 'fe', '′', 'ftm'],
+    'inch': ['in', 'inch', 'inches', 'in.', 'ins', 'inchs', 'i.n.', 'in', '"', '″', 'in'],
+    'metre': ['m', 'meter', 'metres', 'meters', 'mtr', 'met', 'mts', 'mt', 'm.', '₥', 'mₘ'],
+    'millimetre': ['mm', 'millimeter', 'millimetres', 'millimeters', 'mil', 'mms', 'mm.', 'mil.', 'ₘₘ', 'mmₘ'],
+    'yard': ['yd', 'yard', 'yards', 'yds', 'yd.', 'yds', 'ydₘ'],
+    'gram': ['g', 'gram', 'grams', 'gm', 'gms', 'gr', 'grs', '₉', 'gₘ'],
+    'kilogram': ['kg', 'kilo', 'kilogram', 'kilograms', 'kgs', 'klg', 'k.g.', 'kg.', 'ₖ₉', 'kgₘ'],
+    'microgram': ['mcg', 'microgram', 'micrograms', 'mcgs', 'μg', 'ug', 'mc', 'μ₉', 'mcₘ'],
+    'milligram': ['mg', 'milligram', 'milligrams', 'mgs', 'mg.', 'millig', 'ₘ₉', 'mgₘ'],
+    'ounce': ['oz', 'ounce', 'ounces', 'ozs', 'oz.', 'o.z.', '℥'],
+    'pound': ['lb', 'pound', 'pounds', 'lbs', 'lbm', 'lb.', 'pound', 'pds', 'ₗₑ', 'lbₘ'],
+    'ton': ['t', 'ton', 'tons', 'tn', 'tns', 't.', 'tonne', 'ₜ', 'tonₘ'],
+    'kilovolt': ['kv', 'kilovolt', 'kilovolts', 'kvs', 'kV', 'KV', 'ₖV'],
+    'millivolt': ['mv', 'millivolt', 'millivolts', 'mvs', 'mV', 'mV', 'ₘV'],
+    'volt': ['v', 'volt', 'volts', 'vs', 'v.', 'V', 'ₜ'],
+    'kilowatt': ['kw', 'kilowatt', 'kilowatts', 'kws', 'kW', 'KW', 'ₖW'],
+    'watt': ['w', 'watt', 'watts', 'ws', 'w.', 'W', 'ₙ'],
+    'centilitre': ['cl', 'centilitre', 'centilitres', 'cL', 'c.l.', 'cl', 'ₗ'],
+    'cubic foot': ['cu ft', 'cubic foot', 'cubic feet', 'cf', 'cuft', 'ft³', 'ft3'],
+    'cubic inch': ['cu in', 'cubic inch', 'cubic inches', 'ci', 'cuin', 'in³', 'in3'],
+    'cup': ['cup', 'cups', 'c', 'cu', 'cps', 'ₗ'],
+    'decilitre': ['dl', 'decilitre', 'decilitres', 'dL', 'd.l.', 'dl', 'ₗ'],
+    'fluid ounce': ['fl oz', 'fluid ounce', 'fluid ounces', 'floz', 'fl oz', 'f.loz', '℥'],
+    'gallon': ['gal', 'gallon', 'gallons', 'gals', 'gal.', 'gall', 'ₗ'],
+    'imperial gallon': ['imp gal', 'imperial gallon', 'imperial gallons', 'imp.gal', 'imp gal', 'ₗ'],
+    'litre': ['l', 'litre', 'liter', 'litres', 'liters', 'L', 'ltr', 'lt', 'ₗ'],
+    'microlitre': ['μl', 'microlitre', 'microl', 'microlitres'],
+    'millilitre': ['ml', 'millilitre', 'milliliter', 'millilitres', 'milliliters'],
+    'pint': ['pt', 'pint', 'pints'],
+    'quart': ['qt', 'quart', 'quarts']}
+
+
+# Function to generate abbreviation map for a specific entity
+def generate_abbreviation_map(entity_key, entity_unit_map, abbreviation_map):
+    valid_units = entity_unit_map.get(entity_key, set())
+    unit_abbreviation_mapping = {}
+    
+    # Loop over the valid units and map their abbreviations
+    for unit in valid_units:
+        if unit in abbreviation_map:
+            for abbrev in abbreviation_map[unit]:
+                unit_abbreviation_mapping[abbrev] = unit
+        # Also include the full unit as valid
+        unit_abbreviation_mapping[unit] = unit
+    
+    return unit_abbreviation_mapping
+
+# Function to map units and extract the number and unit, including decimals
+def extract_number_and_unit(text, valid_units, unit_mapping):
+    text = text.replace('"', 'inch').replace('″', 'inch')
+    text = text.replace("'", 'foot').replace('′', 'foot')  # foot
+    text = text.replace(',', '.')  # Replace comma with decimal point
+
+    """
+    Extracts numbers followed by units from a given text.
+
+    Args:
+    text (str): The input text.
+    valid_units (list): A list of valid unit names.
+    unit_mapping (dict): A dictionary mapping unit abbreviations to full names.
+
+    Returns:
+    list: A list of extracted number-unit pairs.
+    """
+
+    # Regex to match an integer or decimal number followed by any valid unit or abbreviation
+    pattern = r'(\d+(?:\.\d+)?)\s*([a-zA-Z]+)'
+
+    matches = []
+    for match in re.finditer(pattern, text, re.IGNORECASE):
+        number = match.group(1)
+        unit_abbreviation = match.group(2).lower()
+
+        # Check if the matched unit or abbreviation is valid
+        if unit_abbreviation in unit_mapping:
+            # Convert abbreviation to full unit name
+            full_unit = unit_mapping[unit_abbreviation]
+        elif unit_abbreviation in valid_units:
+            # It's already a valid unit
+            full_unit = unit_abbreviation
+        else:
+            # No valid unit found, skip this match
+            continue
+
+        # Append the matched number and unit
+        matches.append(f"{number} {full_unit}")
+
+    if(len(matches) == 0):
+        return ""
+    
+    return matches[0]
+
+# Function to turn a list of spellings into one regex alternation factored as a trie
+def trie_pattern(words):
+    '''
+    ['cm', 'cms', 'c'] becomes 'c(?:ms?)?', so the regex engine walks shared
+    prefixes once instead of trying every alternative in turn. Longer
+    continuations are tried first, which is the same as ordering a plain
+    alternation longest first.
+    '''
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        optional = '' in node
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        if len(branches) == 1 and len(re.sub(r'\\(.)', r'\1', branches[0])) == 1:
+            body = branches[0]
+        else:
+            body = '(?:' + '|'.join(branches) + ')'
+        return body + '?' if optional else body
+
+    return build(trie)
+
+# Function to build the matcher for one entity, once per process (see get_unit_matcher)
+def compile_unit_matcher(entity_name, entity_unit_map=entity_unit_map, abbreviation_map=abbreviation_map):
+    '''
+    Build one regex for a number followed by any of the entity's units or
+    abbreviations, including multi-word and symbol ones like 'fl oz', 'cu ft',
+    'μg' or 'ft³'.
+
+    Longer spellings win, so 'cu ft' beats 'cu' and 'inches' beats 'in', and
+    a unit may not run straight into another letter,
+    so '1238madw' still does not read as metres.
+
+    Returns:
+    tuple: (compiled pattern, dict of casefolded spelling -> full unit name).
+    '''
+    unit_mapping = generate_abbreviation_map(entity_name, entity_unit_map, abbreviation_map)
+
+    # Matching ignores case, which also takes the micro sign 'µ' tesseract
+    # emits for the table's Greek 'μ'. str.lower() leaves 'µ' alone,
+    # casefold() maps it like the regex does, so spellings are keyed and
+    # looked up casefolded (see lookup_key); an exact casefolded key wins
+    lookup = {}
+    for abbrev, unit in unit_mapping.items():
+        lookup.setdefault(abbrev.casefold(), unit_mapping.get(abbrev.casefold(), unit))
+
+    # No spelling starts with a digit, a point or a space, so giving back part of
+    # the number or of the spaces can never let a unit match: the possessive
+    # quantifiers skip that backtracking, which was a third of the matching time
+    unit_pattern = trie_pattern(lookup)
+    pattern = re.compile(r'(\d++(?:\.\d++)?)\s*+(' + unit_pattern + r')(?![^\W\d_])', re.IGNORECASE)
+    return pattern, lookup
+
+@functools.lru_cache(maxsize=None)
+def get_unit_matcher(entity_name):
+    return compile_unit_matcher(entity_name)
+
+# Function to find the key of a lookup built by compile_unit_matcher that a matched spelling stands for
+def lookup_key(lookup, spelling):
+    '''
+    casefold() agrees with the regex's case-insensitive matching except for
+    a few letters re also equates, like the dotless 'ı' and 'İ' with 'i';
+    those rare spellings are found by matching them against every key. An
+    ASCII spelling that casefold() misses is simply not in lookup, which the
+    candidate tokenizer runs into all the time, so it skips that search.
+
+    Returns:
+    str: the key, or None if the spelling is not in lookup.
+    '''
+    key = spelling.casefold()
+    if key in lookup:
+        return key
+    if spelling.isascii():
+        return None
+    for key in lookup:
+        if re.fullmatch(re.escape(key), spelling, re.IGNORECASE):
+            return key
+    return None
+
+# The same clean-up extract_number_and_unit does, as one str.translate table:
+# inch and foot marks become words and decimal commas become points
+OCR_TEXT_REPLACEMENTS = str.maketrans({'"': 'inch', '″': 'inch', "'": 'foot', '′': 'foot', ',': '.'})
+
+# Function to extract the first number and unit for an entity, using its cached matcher
+def extract_entity_value(text, entity_name):
+    return match_entity_value(text, *get_unit_matcher(entity_name))
+
+# Function to extract the first number and unit a matcher from compile_unit_matcher finds
+def match_entity_value(text, pattern, lookup):
+    text = text.translate(OCR_TEXT_REPLACEMENTS)
+    for match in pattern.finditer(text):
+        full_unit = lookup.get(lookup_key(lookup, match.group(2)))
+        if full_unit is not None:
+            return f"{match.group(1)} {full_unit}"
+    return ""
+
+# The dimension each entity is measured in
+entity_dimension_map = {
+    'width': 'length',
+    'depth': 'length',
+    'height': 'length',
+    'item_weight': 'mass',
+    'maximum_weight_recommendation': 'mass',
+    'voltage': 'voltage',
+    'wattage': 'power',
+    'item_volume': 'volume'
+}
+
+# One number followed by a unit spelling, see extract_unit_candidates
+UnitCandidate = namedtuple('UnitCandidate', ['number', 'unit', 'dimension', 'position', 'spelling'])
+
+# A letter, i.e. what may not follow a unit spelling
+_LETTER = re.compile(r'[^\W\d_]')
+
+# Function to build the matcher for every unit of every entity at once
+@functools.lru_cache(maxsize=None)
+def get_candidate_matcher():
+    '''
+    Returns:
+    tuple: (pattern finding a number and its longest unit spelling at every
+    number start, dict of lowercase spelling -> ((unit, dimension), ...)).
+    '''
+    spelling_units = {}
+    for entity_name, dimension in entity_dimension_map.items():
+        for spelling, unit in get_unit_matcher(entity_name)[1].items():
+            units = spelling_units.setdefault(spelling, [])
+            if (unit, dimension) not in units:
+                units.append((unit, dimension))
+    spelling_units = {spelling: tuple(units) for spelling, units in spelling_units.items()}
+
+    # Overlapping matches (a lookahead) so '1.5.3 cm' still finds '5.3 cm' like the per-entity regex does
+    pattern = re.compile(r'(?<!\d)(?=(\d+(?:\.\d+)?)\s*(' + trie_pattern(spelling_units) + r')(?![^\W\d_]))',
+                         re.IGNORECASE)
+    return pattern, spelling_units
+
+# Function to read every number and unit out of an OCR text in one pass
+def extract_unit_candidates(text):
+    '''
+    Tokenize the text once into candidates for all unit families. Where
+    several spellings fit at one place ('ft3' and 'ft'), each gets its own
+    candidates, longest first, so any entity's answer is a filter over this
+    list (select_entity_value) instead of another regex pass.
+
+    Returns:
+    list: UnitCandidate tuples in text order.
+    '''
+    text = text.translate(OCR_TEXT_REPLACEMENTS)
+    pattern, spelling_units = get_candidate_matcher()
+
+    candidates = []
+    last_unit_start = -1
+    for match in pattern.finditer(text):
+        unit_start = match.start(2)
+        # '5.3 cm' and its tail '3 cm' share the unit; the earlier number is the one a regex would match
+        if unit_start == last_unit_start:
+            continue
+        last_unit_start = unit_start
+
+        number, longest = match.group(1), match.group(2)
+        for length in range(len(longest), 0, -1):
+            spelling = lookup_key(spelling_units, longest[:length])
+            units = spelling_units.get(spelling)
+            if units is None or (length < len(longest) and _LETTER.match(text, unit_start + length)):
+                continue
+            for unit, dimension in units:
+                candidates.append(UnitCandidate(number, unit, dimension, match.start(1), spelling))
+    return candidates
+
+# Function to pick an entity's value from the candidates, same answer as extract_entity_value
+def select_entity_value(candidates, entity_name):
+    lookup = get_unit_matcher(entity_name)[1]
+    for candidate in candidates:
+        if lookup.get(candidate.spelling) == candidate.unit:
+            return f"{candidate.number} {candidate.unit}"
+    return ""
+
+# Function to turn the OCR text of an image into the prediction for an entity
+def predict_from_text(text_in_image, entity_name):
+    # Extract the number and unit from the text
+    return extract_entity_value(text_in_image, entity_name)
+
+# Distinct entities from which one tokenizing pass beats a regex pass per entity
+# (benchmark.py parse: about even at 5, a third faster at 6 and above)
+SINGLE_PASS_MIN_ENTITIES = 6
+
+# Function to turn the OCR text of an image into predictions for several entities
+def predict_all_from_text(text_in_image, entity_names):
+    distinct = list(dict.fromkeys(entity_names))
+    if len(distinct) < SINGLE_PASS_MIN_ENTITIES:
+        # The 2-3 entities an image's rows usually ask for are cheaper one regex pass each
+        values = {entity_name: extract_entity_value(text_in_image, entity_name) for entity_name in distinct}
+        return [values[entity_name] for entity_name in entity_names]
+    # Tokenize once, then each entity is only a filter over the candidates
+    candidates = extract_unit_candidates(text_in_image)
+    return [select_entity_value(candidates, entity_name) for entity_name in entity_names]
+
+# Function to compile every matcher up front, e.g. in a worker's initializer rather than on its first rows
+def warm_unit_matchers():
+    for entity_name in entity_unit_map:
+        get_unit_matcher(entity_name)
+    get_candidate_matcher()